@@ -2,6 +2,9 @@ import argparse
 import binascii
 import sys
 import time
+import queue
+import socket
+import struct
 import threading
 from random import randint
 
@@ -11,6 +14,7 @@ from scapy.all import (
     DUID_LL,
     IP,
     UDP,
+    AsyncSniffer,
     Ether,
     conf,
     get_if_addr,
@@ -18,10 +22,13 @@ from scapy.all import (
     get_if_raw_hwaddr,
     send,
     sendp,
+    raw,
     sniff,
 )
+from scapy.arch.common import compile_filter
+from scapy.interfaces import network_name
 
-__version__ = '1.0.0'
+__version__ = '1.3.0'
 
 
 DEBUG = False
@@ -29,6 +36,23 @@ TIMEOUT = 5
 IFACE = None
 CLIENT_ID = 'aa:bb:cc:dd:ee:ff'
 
+# only dhcp traffic ever reaches python, the kernel drops the rest
+BPF = 'udp and (port 67 or port 68)'
+
+# send prebuilt DISCOVER bytes on a raw socket and parse offers with
+# struct instead of scapy, when the kernel lets us open AF_PACKET
+FAST = True
+ETH_P_IP = 0x0800
+
+# offsets into our own DISCOVER frame - ether 14, ip 20, udp 8
+BOOTP_OFF = 14 + 20 + 8
+UDP_CSUM_OFF = 14 + 20 + 6
+XID_OFF = BOOTP_OFF + 4
+CHADDR_OFF = BOOTP_OFF + 28
+MAGIC = b'\x63\x82\x53\x63'
+XID = struct.Struct('!I')
+PORTS = struct.Struct('!HH')
+
 OK = 0
 WARNING = 1
 CRITICAL = 2
@@ -45,24 +69,311 @@ def mac_str_to_bytes(mac):
     return binascii.unhexlify(mac)
 
 
-def sniffer(dhcp_client):
-    """Starts scapy sniffer and stops when a timeout is reached or a valid packet"""
-    def show_packet(x):
+def bpf_available():
+    # needs libpcap or tcpdump, see the Dockerfile
+    try:
+        compile_filter(BPF)
+    except Exception:
+        return False
+    return True
+
+
+def iface_name(iface=None):
+    return network_name(iface or IFACE or conf.iface)
+
+
+_templates = {}
+
+
+def discover_template(iface=None):
+    """
+    Serialize a DISCOVER once per interface with xid and chaddr left
+    zeroed.  The udp checksum is zeroed too (optional over ipv4) so
+    patching xid/chaddr doesn't mean recomputing it.
+    """
+
+    iface = iface_name(iface)
+    template = _templates.get(iface)
+    if template is None:
+        frame = (
+            Ether(src=get_if_hwaddr(iface), dst=DHCPv4Client.MAC_BROADCAST)
+            / IP(src="0.0.0.0", dst="255.255.255.255")
+            / UDP(sport=68, dport=67)
+            / BOOTP(chaddr=b'\x00' * 16, xid=0, flags=0x8000)
+            / DHCP(options=[("message-type", "discover"), "end"])
+        )
+        template = bytearray(raw(frame))
+        template[UDP_CSUM_OFF:UDP_CSUM_OFF + 2] = b'\x00\x00'
+        _templates[iface] = template
+    return template
+
+
+def discover_bytes(xid, hw, iface=None):
+    # a DISCOVER frame for this xid and mac, ready for a raw socket
+    frame = bytearray(discover_template(iface))
+    XID.pack_into(frame, XID_OFF, xid)
+    frame[CHADDR_OFF:CHADDR_OFF + 6] = mac_str_to_bytes(hw)[:6]
+    return bytes(frame)
+
+
+def parse_offer(frame):
+    """
+    Pull (xid, offered address) out of a raw ethernet frame if it is
+    a DHCPOFFER, None otherwise.  Works on a memoryview so nothing is
+    copied for the packets we throw away.
+    """
+
+    buf = memoryview(frame)
+    n = len(buf)
+    if n < BOOTP_OFF + 240 or buf[12:14] != b'\x08\x00':
+        return None
+    if buf[14 + 9] != 17:
+        return None
+    udp = 14 + (buf[14] & 0x0f) * 4
+    bootp = udp + 8
+    if n < bootp + 240:
+        return None
+    _, dport = PORTS.unpack_from(buf, udp)
+    if dport != 68 or buf[bootp] != 2:
+        return None
+    if buf[bootp + 236:bootp + 240] != MAGIC:
+        return None
+
+    i = bootp + 240
+    while i + 2 < n:
+        code = buf[i]
+        if code == 255:
+            break
+        if code == 0:
+            i += 1
+            continue
+        if code == 53:
+            if buf[i + 2] != 2:
+                return None
+            xid, = XID.unpack_from(buf, bootp + 4)
+            return xid, socket.inet_ntoa(bytes(buf[bootp + 16:bootp + 20]))
+        i += 2 + buf[i + 1]
+    return None
+
+
+def new_xid():
+    return randint(0, (2 ** 24) - 1)  # BOOTP 4 bytes, DHCPv6 3 bytes
+
+
+class Capture:
+    """
+    One long lived sniffer for the whole agent instead of a sniff()
+    thread per check.  A BPF filter keeps everything but dhcp in the
+    kernel, and replies are handed to whichever client is waiting on
+    their xid, so each probe only costs a dict lookup.  offline= reads
+    a pcap instead of the interface, and feed() pushes packets in by
+    hand, for testing without a dhcp server.
+    """
+
+    def __init__(self, iface=None, offline=None):
+        self.iface = iface
+        self.offline = offline
+        self.waiters = {}
+        self.lock = threading.Lock()
+        self.sniffer = None
+
+    def start(self):
+        started = threading.Event()
+        kwargs = {
+            'prn': self.dispatch,
+            'store': False,
+            'started_callback': started.set,
+        }
+        if self.offline:
+            # a recording, dispatch() skips anything that isn't bootp
+            kwargs['offline'] = self.offline
+        else:
+            kwargs['iface'] = self.iface or IFACE
+            if bpf_available():
+                kwargs['filter'] = BPF
+            else:
+                print('no libpcap/tcpdump, sniffing without a filter')
+        self.sniffer = AsyncSniffer(**kwargs)
+        self.sniffer.start()
+        started.wait(1)
+
+    @property
+    def running(self):
+        return self.sniffer is not None and self.sniffer.running
+
+    def stop(self):
+        if self.running:
+            self.sniffer.stop()
+
+    def join(self, timeout=None):
+        # offline captures end by themselves at the end of the file
+        if self.sniffer is not None and self.sniffer.thread is not None:
+            self.sniffer.thread.join(timeout)
+
+    def register(self, client, callback=None):
+        """
+        Wait for replies to client.xid, picking a fresh xid if another
+        client already has it.  Register before crafting the request.
+        callback(client) runs in the sniffer thread on a match.
+        """
+
+        with self.lock:
+            while client.xid in self.waiters:
+                client.xid = new_xid()
+            self.waiters[client.xid] = (client, callback)
+
+    def unregister(self, client):
+        with self.lock:
+            entry = self.waiters.get(client.xid)
+            if entry is not None and entry[0] is client:
+                del self.waiters[client.xid]
+
+    def dispatch(self, packet):
         if DEBUG:
-            x.summary()
-    sniff(
-        prn=show_packet,
-        timeout=TIMEOUT,
-        stop_filter=dhcp_client.is_matching_reply,
-    )
+            print(packet.summary())
+        bootp = packet.getlayer(BOOTP)
+        if bootp is None:
+            return
+        entry = self.waiters.get(bootp.xid)
+        if entry is None:
+            return
+        client, callback = entry
+        if client.reply is None and client.is_matching_reply(packet):
+            client.replied.set()
+            if callback is not None:
+                callback(client)
+
+    def feed(self, packets):
+        for packet in packets:
+            self.dispatch(packet)
+
+
+class RawCapture(Capture):
+    """
+    Capture without scapy in the loop.  Frames come off an AF_PACKET
+    socket (same BPF filter) into one reused buffer and go through
+    parse_offer(), scapy never dissects anything.
+    """
+
+    def start(self):
+        iface = iface_name(self.iface)
+        self.sock = socket.socket(
+            socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_IP))
+        self.sock.bind((iface, 0))
+        if bpf_available():
+            from scapy.arch.linux import attach_filter
+            attach_filter(self.sock, BPF, iface)
+        self.sock.settimeout(0.5)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(
+            target=self.loop, name='dhcp-capture', daemon=True)
+        self.thread.start()
+
+    @property
+    def running(self):
+        return getattr(self, 'thread', None) is not None and self.thread.is_alive()
+
+    def stop(self):
+        if self.running:
+            self.stopping.set()
+            self.thread.join()
+            self.sock.close()
+
+    def join(self, timeout=None):
+        if self.running:
+            self.thread.join(timeout)
+
+    def loop(self):
+        buf = bytearray(2048)
+        view = memoryview(buf)
+        while not self.stopping.is_set():
+            try:
+                n = self.sock.recv_into(buf)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.dispatch_raw(view[:n])
+
+    def dispatch_raw(self, frame):
+        offer = parse_offer(frame)
+        if offer is None:
+            return
+        xid, address = offer
+        entry = self.waiters.get(xid)
+        if entry is None:
+            return
+        client, callback = entry
+        if client.reply is not None:
+            return
+        client.reply = bytes(frame)
+        client.offered_address = address
+        client.replied.set()
+        if callback is not None:
+            callback(client)
+
+    def feed_raw(self, frames):
+        for frame in frames:
+            self.dispatch_raw(frame)
+
+
+_raw_socket = None
+_fast = None
+
+
+def fast_path():
+    # FAST and allowed to open packet sockets (root / CAP_NET_RAW)
+    global _fast
+    if _fast is None:
+        _fast = False
+        if FAST and hasattr(socket, 'AF_PACKET'):
+            try:
+                socket.socket(socket.AF_PACKET, socket.SOCK_RAW).close()
+                _fast = True
+            except OSError:
+                pass
+    return _fast
+
+
+def raw_socket(iface=None):
+    global _raw_socket
+    if _raw_socket is None:
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+        sock.bind((iface_name(iface), 0))
+        _raw_socket = sock
+    return _raw_socket
+
+
+_capture = None
+_capture_lock = threading.Lock()
+
+
+def get_capture(iface=IFACE):
+    """
+    The agent wide Capture, started on first use and restarted if
+    the sniffer ever dies.
+    """
+
+    global _capture
+    with _capture_lock:
+        if _capture is None or not _capture.running:
+            klass = RawCapture if fast_path() else Capture
+            _capture = klass(iface)
+            _capture.start()
+        return _capture
+
+
+def new_client():
+    return FastDHCPv4Client() if fast_path() else DHCPv4Client()
 
 
 class DHCPClient:
-    def __init__(self):
-        self.xid = randint(0, (2 ** 24) - 1)  # BOOTP 4 bytes, DHCPv6 3 bytes
+    def __init__(self, xid=None):
+        self.xid = new_xid() if xid is None else xid
         self.request = None
         self.reply = None
-        self.sniffer = None
+        self.replied = threading.Event()
+        self.capture = None
         self.offered_address = None
 
     def craft_request(self, *args, **kwargs):
@@ -77,14 +388,15 @@ class DHCPClient:
             Ether(dst=self._get_ether_dst()) / self.request, verbose=DEBUG
         )
 
-    def sniff_start(self):
-        """Starts listening for packets in a new thread"""
-        self.sniffer = threading.Thread(target=sniffer, args=[self])
-        self.sniffer.start()
+    def sniff_start(self, capture=None):
+        """Starts listening for our xid on the shared capture"""
+        self.capture = capture or get_capture()
+        self.capture.register(self)
 
-    def sniff_stop(self):
-        """Waits for sniffer thread to finish"""
-        self.sniffer.join()
+    def sniff_stop(self, timeout=TIMEOUT):
+        """Waits for a reply or the timeout, then stops listening"""
+        self.replied.wait(timeout)
+        self.capture.unregister(self)
 
     def is_matching_reply(self, reply):
         """Checks that we got reply packet"""
@@ -149,8 +461,9 @@ class DHCPv4Client(DHCPClient):
 
 
     def go(self, mac=CLIENT_ID):
-        self.craft_request(hw=mac)
+        # register first, the capture may hand us a different xid
         self.sniff_start()
+        self.craft_request(hw=mac)
         ts = time.time()
         self.send()
         self.sniff_stop()
@@ -166,3 +479,95 @@ class DHCPv4Client(DHCPClient):
             return results
         else:
             results = { 'alive': False, 'response': 'no dhcp offered'}
+            return results
+
+
+class FastDHCPv4Client(DHCPv4Client):
+    """
+    DHCPv4Client that patches a prebuilt DISCOVER template instead of
+    building the scapy layers and writes it straight to a raw socket.
+    """
+
+    def craft_discover(self, hw=None):
+        if not hw:
+            hw = get_if_hwaddr(iface_name())
+        return discover_bytes(self.xid, hw)
+
+    def send(self):
+        raw_socket().send(self.request)
+
+
+def discover_many(macs, timeout=TIMEOUT):
+    """
+    DISCOVER for a whole batch of MACs on the shared capture.
+    Generator, yields (mac, results) as the offers come in and the
+    leftovers as failures once the timeout is up.
+    """
+
+    if not macs:
+        return
+    capture = get_capture()
+    offers = queue.Queue()
+
+    def on_reply(client):
+        offers.put((client, time.time()))
+
+    clients = {}
+    for mac in macs:
+        client = new_client()
+        capture.register(client, on_reply)
+        client.craft_request(hw=mac)
+        clients[client.xid] = (mac, client)
+
+    ts = time.time()
+    for _, client in clients.values():
+        client.send()
+
+    pending = {xid for xid in clients}
+    deadline = ts + timeout
+    try:
+        while pending:
+            left = deadline - time.time()
+            if left <= 0:
+                break
+            try:
+                client, te = offers.get(timeout=left)
+            except queue.Empty:
+                break
+            mac, _ = clients[client.xid]
+            pending.discard(client.xid)
+            response = 'offered {} in {}ms'.format(
+              client.offered_address, round(te-ts, 3))
+            yield mac, {'alive': True, 'response': response}
+    finally:
+        for _, client in clients.values():
+            capture.unregister(client)
+
+    for xid in pending:
+        mac, _ = clients[xid]
+        yield mac, {'alive': False, 'response': 'no dhcp offered'}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='dhcp probe')
+    parser.add_argument('--iface', default=IFACE)
+    parser.add_argument('--mac', default=CLIENT_ID)
+    parser.add_argument('--pcap', help='replay offers from a pcap')
+    parser.add_argument('--xid', type=lambda x: int(x, 0),
+                        help='xid to look for in the pcap')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+    DEBUG = args.debug
+
+    if args.pcap:
+        # no packets go out, just check the capture finds the offer
+        capture = Capture(offline=args.pcap)
+        client = DHCPv4Client(xid=args.xid)
+        capture.register(client)
+        capture.start()
+        capture.join(TIMEOUT)
+        print(client.offered_address or 'no dhcp offered')
+        sys.exit(OK if client.reply else CRITICAL)
+
+    IFACE = args.iface
+    print(new_client().go(args.mac))
@@ -9,16 +9,26 @@
 
 import os
 import sys
+import hmac
 import logging
 import pkg_resources
 import json
-from dhcp import DHCPv4Client
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dhcp import new_client
+from dhcp import discover_many
+import probes
 
 from flask import Flask
+from flask import request
+from flask import Response
+from flask import stream_with_context
+from functools import wraps
 
 ############################################
 
-__version__ = '0.0.3'
+__version__ = '0.0.6'
 
 IFACE = 'eno3'
 MAC = 'aa:bb:cc:11:22:34'
@@ -27,6 +37,9 @@ PIP_VERSION = os.environ.get('PYTHON_PIP_VERSION', '1.0')
 PYTHON_VERSION = os.environ.get('PYTHON_VERSION', '1.0')
 DOCKER_HOSTNAME = os.environ.get('HOSTNAME', 'NO_HOSTNAME')
 SERVER_SOFTWARE = os.environ.get('SERVER_SOFTWARE', 'server/1.0')
+# shared with pyping (agent_token in site.yml), /_probe and /_batch
+# stay closed without it - they reach anything the host can
+AGENT_TOKEN = os.environ.get('AGENT_TOKEN', '')
 SERVER_VERSION = SERVER_SOFTWARE.split('/')[1]
 FLASK_VERSION = pkg_resources.get_distribution("flask").version
 HOST_VERSION = __version__
@@ -56,6 +69,18 @@ app.logger.info('pinger hosted via {} on docker host {}'.format(
 
 ############################################
 
+def require_token(f):
+    """ Bearer token check for the endpoints that probe arbitrary targets """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        given = request.headers.get('Authorization', '')
+        if not AGENT_TOKEN:
+            return json.dumps({'error': 'AGENT_TOKEN is not set'}), 403
+        if not hmac.compare_digest(given, f'Bearer {AGENT_TOKEN}'):
+            return json.dumps({'error': 'bad token'}), 401
+        return f(*args, **kwargs)
+    return wrapper
+
 @app.route("/")
 def index():
     """Fake handler"""
@@ -63,13 +88,124 @@ def index():
 
 @app.route("/_dhcp/<mac>")
 def dhcp(mac=MAC):
-    client = DHCPv4Client()
+    client = new_client()
     try:
         results = client.go(mac)
     except Exception as e:
         results = { 'alive': False, 'e': str(e) }
     return json.dumps(results)
 
+@app.route("/_probe", methods=['POST'])
+@require_token
+def probe():
+    """
+    Bulk tcp/icmp/http probes, see probes.py.  POST json like
+    {"timeout": 3, "probes": [{"id": ..., "type": "tcp", ...}]}
+    and get {"results": [...]} back in the same order.
+    """
+
+    body = request.get_json(force=True, silent=True)
+    timeout = parse_timeout(body)
+    specs = body.get('probes', []) if isinstance(body, dict) else None
+    if timeout is None or not isinstance(specs, list) \
+            or len(specs) > probes.MAX_PROBES \
+            or not all(isinstance(spec, dict) for spec in specs):
+        return json.dumps({'error': 'bad probe list'}), 400
+    results = probes.run(specs, timeout)
+    return json.dumps({'results': results})
+
+def parse_timeout(body):
+    """ Seconds to wait from a request body, capped, None if it's junk """
+    if not isinstance(body, dict):
+        return None
+    try:
+        return min(float(body.get('timeout', probes.TIMEOUT)), 30)
+    except (TypeError, ValueError):
+        return None
+
+def parse_items(items):
+    """
+    Split /_batch items into ({mac: [ids]}, [probe specs]).  Raises
+    ValueError on anything malformed, ids have to be unique since
+    results are matched up by them.
+    """
+    if not isinstance(items, list) or len(items) > probes.MAX_PROBES:
+        raise ValueError('bad item list')
+    macs = {}
+    specs = []
+    ids = set()
+    for item in items:
+        if isinstance(item, str):
+            item = {'id': item, 'type': 'dhcp', 'mac': item}
+        if not isinstance(item, dict) or not isinstance(item.get('id'), str):
+            raise ValueError('every item needs a string id')
+        if item['id'] in ids:
+            raise ValueError('duplicate id {}'.format(item['id']))
+        ids.add(item['id'])
+        if item.get('type') == 'dhcp':
+            mac = item.get('mac')
+            if not isinstance(mac, str) or not mac:
+                raise ValueError('dhcp item {} has no mac'.format(item['id']))
+            # two services may well watch the same mac
+            macs.setdefault(mac, []).append(item['id'])
+        else:
+            specs.append(item)
+    return macs, specs
+
+@app.route("/_batch", methods=['POST'])
+@require_token
+def batch():
+    """
+    Many checks in one request, results streamed back as ndjson in
+    whatever order they finish, one per item id.  Items are MAC
+    strings for a dhcp check or probe specs (see probes.py),
+    {"type": "dhcp", "id": .., "mac": ..} included.  All the dhcp
+    items share a single sniffer.
+
+        {"timeout": 5, "items": ["aa:bb:..", {"id": "web", ...}]}
+    """
+
+    body = request.get_json(force=True, silent=True)
+    timeout = parse_timeout(body)
+    if timeout is None:
+        return json.dumps({'error': 'bad request'}), 400
+    try:
+        macs, specs = parse_items(body.get('items', []))
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400
+
+    done = queue.Queue()
+
+    def run_dhcp():
+        seen = set()
+        try:
+            for mac, results in discover_many(list(macs), timeout):
+                seen.add(mac)
+                for id in macs[mac]:
+                    done.put(dict(results, id=id))
+        except Exception as e:
+            for mac, ids in macs.items():
+                if mac not in seen:
+                    for id in ids:
+                        done.put({'id': id, 'alive': False, 'e': str(e)})
+
+    if macs:
+        threading.Thread(target=run_dhcp, daemon=True).start()
+    if specs:
+        pool = ThreadPoolExecutor(max_workers=min(probes.WORKERS, len(specs)))
+        for spec in specs:
+            pool.submit(lambda s: done.put(probes.probe(s, timeout)), spec)
+        pool.shutdown(wait=False)
+
+    def generate():
+        # only one result per item, the dhcp thread makes sure of it
+        n = sum(len(ids) for ids in macs.values()) + len(specs)
+        for _ in range(n):
+            yield json.dumps(done.get()) + '\n'
+
+    return Response(
+        stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route("/_env")
 def all_env():
     return str(os.environ)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+#---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Generic probes so pyping can ask this agent for a second opinion
+before it calls a service dead.  A probe spec is a dict:
+
+    {'id': 'web', 'type': 'http', 'url': 'https://...', 'method': 'HEAD'}
+    {'id': 'ssh', 'type': 'tcp', 'ip': '10.0.0.1', 'port': 22}
+    {'id': 'gw', 'type': 'icmp', 'ip': '10.0.0.254'}
+
+and every result is {'id', 'alive', 'response', 'ms'}.
+"""
+
+import time
+import socket
+import subprocess
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+__version__ = '1.0.0'
+
+TIMEOUT = 3
+WORKERS = 32
+MAX_PROBES = 1000
+
+
+def tcp(spec, timeout):
+    s = socket.create_connection((spec['ip'], int(spec['port'])), timeout)
+    s.close()
+    return 'connected'
+
+
+def icmp(spec, timeout):
+    command = ['ping', '-c', '1', '-W', str(max(int(timeout), 1)), spec['ip']]
+    result = subprocess.run(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        raise Exception('ICMP host is not alive')
+    return 'ping ok'
+
+
+def http(spec, timeout):
+    req = urllib.request.Request(
+        spec['url'], method=spec.get('method', 'GET').upper())
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as r:
+            status = r.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    if status != 200:
+        raise Exception(
+          'Expected status code 200 but received {}'.format(status))
+    return 'status-code: {}'.format(status)
+
+
+PROBES = {
+    'tcp': tcp,
+    'icmp': icmp,
+    'http': http,
+}
+
+
+def probe(spec, timeout=TIMEOUT):
+    # run one probe spec, never raises
+    result = {'id': spec.get('id'), 'alive': False, 'ms': 0.0}
+    ts = time.monotonic()
+    check = PROBES.get(spec.get('type'))
+    if check is None:
+        result['response'] = 'unknown probe type {}'.format(spec.get('type'))
+        return result
+    try:
+        result['response'] = check(spec, timeout)
+        result['alive'] = True
+    except KeyError as e:
+        result['response'] = 'bad probe, missing {}'.format(e)
+    except Exception as e:
+        result['response'] = str(e)
+    result['ms'] = round((time.monotonic() - ts) * 1000, 2)
+    return result
+
+
+def run(specs, timeout=TIMEOUT, workers=WORKERS):
+    """
+    Run a batch of probe specs concurrently, results come back in
+    the same order as the specs.
+    """
+
+    if not specs:
+        return []
+    workers = min(workers, len(specs))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda s: probe(s, timeout), specs))
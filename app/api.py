@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Helpers for the /api/v1 endpoints in main.py - query parsing,
+filtering, sparse fieldsets and json/msgpack output.
+"""
+
+import json
+
+from flask import request
+from flask import Response
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__version__ = '1.1'
+
+API_VERSION = 'v1'
+MSGPACK = 'application/msgpack'
+MAX_PER_PAGE = 1000
+
+
+class BadRequest(Exception):
+    pass
+
+
+def parse_bool(value):
+    if value is None:
+        return None
+    value = value.lower()
+    if value in ('1', 'true', 'yes', 'up'):
+        return True
+    if value in ('0', 'false', 'no', 'down'):
+        return False
+    raise BadRequest(f'expected true/false, got {value}')
+
+
+def parse_query(args, per_page_default):
+    """
+    Pull the status query out of request.args:
+        ?service_type=tcp,http  ?alive=false
+        ?fields=name,alive      ?page=2&per_page=100
+    """
+
+    q = {}
+    types = args.get('service_type')
+    q['service_type'] = set(types.lower().split(',')) if types else None
+    q['alive'] = parse_bool(args.get('alive'))
+    fields = args.get('fields')
+    q['fields'] = fields.split(',') if fields else None
+    try:
+        q['page'] = max(int(args.get('page', 1)), 1)
+        q['per_page'] = int(args.get('per_page', per_page_default))
+    except ValueError:
+        raise BadRequest('page and per_page must be integers')
+    q['per_page'] = min(max(q['per_page'], 1), MAX_PER_PAGE)
+    return q
+
+
+def paginate(items, page, per_page):
+    start = (page - 1) * per_page
+    return items[start:start + per_page]
+
+
+def sparse(d, fields):
+    # always keep name so results can be matched up
+    if not fields:
+        return d
+    return {k: v for k, v in d.items() if k in fields or k == 'name'}
+
+
+def wants_msgpack():
+    if msgpack is None:
+        return False
+    if request.args.get('format') == 'msgpack':
+        return True
+    best = request.accept_mimetypes.best_match(
+        ['application/json', MSGPACK])
+    return best == MSGPACK
+
+
+def respond(payload, headers):
+    """
+    Encode as msgpack when asked for (and installed), json
+    otherwise.  Vary on Accept so caches keep both.
+    """
+
+    headers = dict(headers, Vary='Accept')
+    if wants_msgpack():
+        body = msgpack.packb(payload, use_bin_type=True)
+        return Response(body, headers=headers, mimetype=MSGPACK)
+    body = json.dumps(payload, separators=(',', ':'), default=str)
+    return Response(body, headers=headers, mimetype='application/json')
+
+
+def respond_304(headers):
+    # same Vary as respond(), or a cache could hand the json 304 to
+    # a msgpack client
+    return Response(status=304, headers=dict(headers, Vary='Accept'))
+
+
+def error(msg, status=400):
+    body = json.dumps({'error': msg})
+    return Response(body, status=status, mimetype='application/json')
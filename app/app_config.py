@@ -8,22 +8,43 @@
 # --------------------------------------------------------------------------
 
 from os import environ
-import pkg_resources
 import yaml as _yaml
 from munch import munchify
 
-__version__ = '2.2'
+__version__ = '2.4'
 
 ######################################
 
 
+class Versions(dict):
+    """
+    Package versions are only looked up (importlib.metadata) the
+    first time someone asks, pkg_resources used to cost every
+    worker a good chunk of its boot time.
+    """
+
+    DISTS = {
+        'flask_version': 'flask',
+        'redis_version': 'redis',
+    }
+
+    def __missing__(self, key):
+        if key not in self.DISTS:
+            raise KeyError(key)
+        from importlib import metadata
+        try:
+            value = metadata.version(self.DISTS[key])
+        except metadata.PackageNotFoundError:
+            value = 'unknown'
+        self[key] = value
+        return value
+
+
 # misc version info, stored in ver dictionary: app.config['ver']
-ver = {}
+ver = Versions()
 ver['pip_version'] = environ.get('PYTHON_PIP_VERSION', '1.0')
 ver['python_version'] = environ.get('PYTHON_VERSION', '1.0')
 ver['server_software'] = environ.get('SERVER_SOFTWARE', 'server/1.0')
-ver['flask_version'] = pkg_resources.get_distribution("flask").version
-ver['redis_version'] = pkg_resources.get_distribution("redis").version
 
 # Do our "live in Docker" vs "running in Flask debugger" setup
 if environ.get('INSIDE_CONTAINER'):
@@ -41,10 +62,18 @@ else:
 
 # read in user config
 site_cfg = './config/site.yml'
-# Read YAML file
-with open(site_cfg, 'r') as stream:
-    parsed_yaml = _yaml.safe_load(stream)
-yaml = munchify(parsed_yaml)
+# the libyaml loader when PyYAML was built with it, much quicker
+Loader = getattr(_yaml, 'CSafeLoader', _yaml.SafeLoader)
+
+
+def read_site(path=site_cfg):
+    # Read YAML file, also used to hot-reload it - see siteconfig.py
+    with open(path, 'r') as stream:
+        parsed_yaml = _yaml.load(stream, Loader=Loader)
+    return munchify(parsed_yaml)
+
+
+yaml = read_site()
 
 
 class Config(object):
@@ -67,3 +96,86 @@ class Config(object):
     MAC_PLACEHOLDER = '<<MAC>>'
     TIMEOUT = 3
     SEND_NOTIFICATIONS = True
+
+    # concurrent sweep - see sweep.py
+    SWEEP_WORKERS = yaml.get('sweep_workers', 32)
+    SWEEP_DEADLINE = yaml.get('sweep_deadline', 240)
+    SWEEP_TYPE_LIMITS = {
+        'tcp': 32,
+        'icmp': 16,
+        'http': 16,
+        'ntp': 8,
+        'dhcp': 2,
+    }
+    SWEEP_TYPE_LIMITS.update(yaml.get('sweep_type_limits', {}))
+    # tcp/http/ntp probes run on one asyncio loop instead - see aprobe.py
+    SWEEP_ASYNC = yaml.get('sweep_async', True)
+    SWEEP_ASYNC_CONCURRENCY = yaml.get('sweep_async_concurrency', 1000)
+    # all icmp services share one socket - see icmp.py
+    SWEEP_MULTIPING = yaml.get('sweep_multiping', True)
+
+    # shared keep-alive http pools - see httppool.py
+    HTTP_POOL_CONNECTIONS = yaml.get('http_pool_connections', 100)
+    HTTP_POOL_MAXSIZE = yaml.get('http_pool_maxsize', 10)
+    HTTP_KEEPALIVE = yaml.get('http_keepalive', 330)
+    HTTP_HEAD_ONLY = yaml.get('http_head_only', False)
+    # the dhcp agent waits up to 5s for an offer before answering
+    AGENT_TIMEOUT = 10
+    DHCP_OFFER_TIMEOUT = 5
+    # one request per agent per sweep for all its dhcp services, needs
+    # agent 0.0.6+ and agent_token (older agents fall back per service)
+    SWEEP_DHCP_BATCH = yaml.get('sweep_dhcp_batch', False)
+
+    # recent incidents on the homepage - see history.py
+    HISTORY_LIMIT = yaml.get('history_limit', 20)
+    HISTORY_DAYS = yaml.get('history_days', 30)
+    HISTORY_CACHE_TTL = yaml.get('history_cache_ttl', 3600)
+
+    # notifications go through a queue to notifier.py, off by default
+    # so nothing goes quiet on a deploy that doesn't run notifier.py
+    NOTIFY_QUEUE = yaml.get('notify_queue', False)
+    NOTIFY_COALESCE = yaml.get('notify_coalesce', 5)
+    NOTIFY_BATCH = 50
+    NOTIFY_BACKOFF = 30
+    NOTIFY_MAX_ATTEMPTS = 5
+
+    # per service check interval, only used by scheduler.py
+    CHECK_INTERVAL = yaml.get('check_interval', 300)
+    CHECK_JITTER = yaml.get('check_jitter', 0.1)
+    # a failed check is confirmed this many seconds later instead of
+    # waiting a whole interval, stable services back off
+    CHECK_RECHECK = yaml.get('check_recheck', 10)
+    CHECK_STABLE_AFTER = yaml.get('check_stable_after', 12)
+    CHECK_MAX_INTERVAL = yaml.get('check_max_interval', 1800)
+    SCHEDULER_TICK = 1
+    SCHEDULER_DEADLINE = 60
+    # batches checking at once, a tick doesn't wait for the last one
+    SCHEDULER_BATCHES = 4
+
+    # several scheduler.py nodes sharing the services - see cluster.py
+    CLUSTER = yaml.get('cluster', False)
+    CLUSTER_NODE_TTL = yaml.get('cluster_node_ttl', 15)
+    CLUSTER_HEARTBEAT = 5
+    CLUSTER_VNODES = 64
+
+    # remote agents double check failures - see vantage.py
+    VANTAGE_AGENTS = yaml.get('agents', [])
+    VANTAGE_QUORUM = yaml.get('vantage_quorum', 2)
+    # sent to the agents' /_probe and /_batch, their AGENT_TOKEN
+    AGENT_TOKEN = yaml.get('agent_token', '')
+
+    # site.yml services/subscribers are re-read when the file changes
+    CONFIG_RELOAD = yaml.get('config_reload', True)
+    CONFIG_POLL = 5
+
+    # per phase timings of every sweep, optionally profiled - see tracing.py
+    TRACE = yaml.get('trace', True)
+    TRACE_KEEP = 20
+    PROFILE = yaml.get('profile', False) or bool(environ.get('PYPING_PROFILE'))
+    PROFILE_INTERVAL = 0.005
+
+    # uptime figures are recomputed at least this often - see sla.py
+    SLA_CACHE_TTL = yaml.get('sla_cache_ttl', 300)
+
+    # /api/v1/status default page size
+    API_PER_PAGE = 100
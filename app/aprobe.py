@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+import time
+import struct
+import asyncio
+import threading
+
+import aiohttp
+
+__version__ = '1.1'
+
+# seconds between the ntp epoch (1900) and the unix epoch (1970)
+NTP_DELTA = 2208988800
+NTP_PACKET = struct.Struct('!B B B b 11I')
+
+_loop = None
+_engine = None
+_lock = threading.Lock()
+
+
+#################################
+#                               #
+#         NTP protocol          #
+#                               #
+#################################
+
+
+def to_ntp_time(ts):
+    # unix float -> (seconds, fraction) in ntp format
+    ts = ts + NTP_DELTA
+    return int(ts), int((ts - int(ts)) * 2 ** 32)
+
+
+def from_ntp_time(secs, frac):
+    # ntp (seconds, fraction) -> unix float
+    return secs + float(frac) / 2 ** 32 - NTP_DELTA
+
+
+class NTPProtocol(asyncio.DatagramProtocol):
+    """
+    Bare minimum client side of RFC 5905.  Sends one mode 3 packet
+    and resolves the future with the clock offset once the server
+    answers, same math as ntplib.
+    """
+
+    def __init__(self, future):
+        self.future = future
+        self.orig = None
+
+    def connection_made(self, transport):
+        self.orig = time.time()
+        tx_secs, tx_frac = to_ntp_time(self.orig)
+        fields = [0] * 11
+        fields[9] = tx_secs
+        fields[10] = tx_frac
+        # LI = 0, VN = 3, Mode = 3 (client)
+        packet = NTP_PACKET.pack(0x1b, 0, 0, 0, *fields)
+        transport.sendto(packet)
+
+    def datagram_received(self, data, addr):
+        dest = time.time()
+        if self.future.done():
+            return
+        if len(data) < NTP_PACKET.size:
+            self.future.set_exception(Exception('Invalid NTP packet'))
+            return
+        fields = NTP_PACKET.unpack(data[:NTP_PACKET.size])
+        words = fields[4:]
+        recv = from_ntp_time(words[7], words[8])
+        tx = from_ntp_time(words[9], words[10])
+        offset = ((recv - self.orig) + (tx - dest)) / 2
+        self.future.set_result(offset)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+#################################
+#                               #
+#         Engine                #
+#                               #
+#################################
+
+
+class Engine:
+    """
+    One event loop worth of probing.  Holds the shared aiohttp
+    session and the concurrency cap, services call back into the
+    engine from their _acheck() methods.  The engine lives as long
+    as the worker so the session's keep-alive connections carry
+    over from one sweep to the next.
+    """
+
+    def __init__(self, concurrency, keepalive):
+        self.concurrency = concurrency
+        self.keepalive = keepalive
+        self.semaphore = None
+        self.session = None
+
+    async def open(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency,
+            keepalive_timeout=self.keepalive
+        )
+        self.session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def close(self):
+        await self.session.close()
+
+    async def tcp_connect(self, ip, port, timeout):
+        # non-blocking connect, we just want to see the handshake finish
+        try:
+            conn = asyncio.open_connection(ip, port)
+            reader, writer = await asyncio.wait_for(conn, timeout)
+        except asyncio.TimeoutError:
+            raise Exception('timed out')
+        writer.close()
+
+    async def http_status(self, url, timeout, method='GET'):
+        t = aiohttp.ClientTimeout(total=timeout)
+        request = self.session.request(
+            method, url, timeout=t, allow_redirects=True)
+        try:
+            async with request as response:
+                return response.status
+        except asyncio.TimeoutError:
+            raise Exception(f'timed out fetching {url}')
+
+    async def ntp_offset(self, ip, timeout, port=123):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: NTPProtocol(future),
+            remote_addr=(ip, port)
+        )
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise Exception(f'No response received from {ip}.')
+        finally:
+            transport.close()
+
+    async def _probe(self, svc):
+        async with self.semaphore:
+            response, error = await svc.acheck(self)
+        return svc, response, error
+
+    async def run(self, services, deadline):
+        """
+        Probe everything at once.  Services that miss the deadline
+        are cancelled and left out of the results.
+        """
+
+        tasks = [asyncio.ensure_future(self._probe(s)) for s in services]
+        if not tasks:
+            return []
+        done, pending = await asyncio.wait(tasks, timeout=deadline)
+        for task in pending:
+            task.cancel()
+        return [task.result() for task in done]
+
+
+def get_engine(concurrency, keepalive):
+    """
+    Lazily start the worker's probe loop in a daemon thread and
+    open the engine on it.  Only the first caller's settings count.
+    """
+
+    global _loop, _engine
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            t = threading.Thread(
+                target=loop.run_forever,
+                name='aprobe',
+                daemon=True
+            )
+            t.start()
+            engine = Engine(concurrency, keepalive)
+            asyncio.run_coroutine_threadsafe(engine.open(), loop).result()
+            _loop, _engine = loop, engine
+    return _loop, _engine
+
+
+def run(services, concurrency, deadline, keepalive=15):
+    """
+    Entry point for the sweeper.  Blocks the calling thread while
+    the probes run on the shared loop.  Returns a list of
+    (service, response, error) tuples for settle().
+    """
+
+    loop, engine = get_engine(concurrency, keepalive)
+    coro = engine.run(services, deadline)
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
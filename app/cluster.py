@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Several checker nodes sharing one site.yml through redis.
+
+<ns>:nodes      zset of node id -> last heartbeat
+<ns>:leader     node id of the scheduler leader, expires unless renewed
+<ns>:cron       the same for /_cron, one web worker sweeps at a time
+
+Every node heartbeats into the zset, anything that hasn't for
+CLUSTER_NODE_TTL seconds is dropped.  Services are spread over the
+live nodes with a consistent hash ring, so when a node joins or
+dies only its share of the services moves.  The locks are a plain
+SET NX with an expiry.  They are separate so a scheduler leader
+doesn't keep /_cron from ever running, or the other way round.
+"""
+
+import os
+import time
+import bisect
+import socket
+import hashlib
+
+__version__ = '1.1'
+
+# compare-and-expire so we only ever renew our own lock
+RENEW = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def node_id():
+    # NODE_ID from the environment, or something unique enough
+    return os.environ.get('NODE_ID') or f'{socket.gethostname()}-{os.getpid()}'
+
+
+def point(s):
+    return int.from_bytes(hashlib.md5(s.encode()).digest()[:8], 'big')
+
+
+class Ring:
+    """
+    Consistent hash ring.  Each node gets vnodes points on the ring,
+    a service belongs to the first node point at or after its own.
+    """
+
+    def __init__(self, nodes, vnodes=64):
+        self.nodes = sorted(nodes)
+        points = []
+        for node in self.nodes:
+            for i in range(vnodes):
+                points.append((point(f'{node}#{i}'), node))
+        points.sort()
+        self.points = [p for p, _ in points]
+        self.owners = [n for _, n in points]
+
+    def owner(self, name):
+        if not self.points:
+            return None
+        i = bisect.bisect(self.points, point(name)) % len(self.points)
+        return self.owners[i]
+
+
+class Cluster:
+    def __init__(self, redis, namespace, ttl=15, vnodes=64, node=None):
+        self.redis = redis
+        self.namespace = namespace
+        self.ttl = ttl
+        self.vnodes = vnodes
+        self.node = node or node_id()
+        self.renew = redis.register_script(RENEW)
+        self.ring = Ring([self.node], vnodes)
+
+    @property
+    def nodes_key(self):
+        return f'{self.namespace}:nodes'
+
+    @property
+    def leader_key(self):
+        return self.lock_key()
+
+    def lock_key(self, lock='leader'):
+        return f'{self.namespace}:{lock}'
+
+    def heartbeat(self):
+        """
+        Say we're alive, forget nodes that stopped saying so, and
+        rebuild the ring from whoever is left.  Returns True when
+        the membership changed since the last heartbeat.
+        """
+
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(self.nodes_key, {self.node: now})
+        pipe.zremrangebyscore(self.nodes_key, '-inf', now - self.ttl)
+        pipe.zrange(self.nodes_key, 0, -1)
+        _, _, nodes = pipe.execute()
+
+        nodes = sorted(n.decode('utf-8') for n in nodes)
+        if nodes == self.ring.nodes:
+            return False
+        self.ring = Ring(nodes, self.vnodes)
+        return True
+
+    def leave(self):
+        # clean shutdown, the others rebalance on their next heartbeat
+        self.redis.zrem(self.nodes_key, self.node)
+        self.renew(keys=[self.leader_key], args=[self.node, 0])
+
+    def owns(self, name):
+        return self.ring.owner(name) == self.node
+
+    def lead(self, ttl=None, lock='leader'):
+        """
+        Take or keep a lock (the scheduler leader by default) for
+        ttl seconds (the node ttl by default).  Returns True while
+        we hold it, the lock lapses on its own if the holder dies.
+        """
+
+        ttl = ttl or self.ttl
+        key = self.lock_key(lock)
+        if self.redis.set(key, self.node, nx=True, ex=ttl):
+            return True
+        return bool(self.renew(keys=[key], args=[self.node, ttl]))
+
+    def leader(self, lock='leader'):
+        leader = self.redis.get(self.lock_key(lock))
+        return leader.decode('utf-8') if leader else None
+
+    def members(self):
+        # live node ids, read only - doesn't heartbeat for us
+        now = time.time()
+        nodes = self.redis.zrangebyscore(self.nodes_key, now - self.ttl, '+inf')
+        return sorted(n.decode('utf-8') for n in nodes)
+
+    def status(self, names=()):
+        # who is up, who leads, and how the given services are spread
+        ring = Ring(self.members(), self.vnodes)
+        shares = {n: 0 for n in ring.nodes}
+        for name in names:
+            owner = ring.owner(name)
+            if owner is not None:
+                shares[owner] += 1
+        return {
+            'node': self.node,
+            'leader': self.leader(),
+            'nodes': shares,
+        }
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+import json
+import time
+from flask import current_app as app
+
+__version__ = '1.0'
+
+
+def channel(namespace):
+    return f'{namespace}:events'
+
+
+def publish(svc, alive):
+    """
+    Tell stream.py that a service just flipped up or down.  Only
+    the changed service goes out, browsers patch their own page.
+    Never lets a redis hiccup fail the check itself.
+    """
+
+    event = {
+        'name': svc.name,
+        'alive': alive,
+        'ts': int(time.time()),
+        'response': svc.response,
+    }
+    try:
+        app.redis.publish(
+            channel(app.config['YAML'].url), json.dumps(event))
+    except Exception as e:
+        app.logger.error(f'event publish failed: {e}')
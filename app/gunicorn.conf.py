@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Picked up by gunicorn from the working directory, for the worker
+timeout and the multiprocess metrics bookkeeping, see metrics.py.
+"""
+
+from app_config import Config
+
+# GET /_cron holds its worker for the whole sweep, failures confirmed
+# (sweep.py) inside the same deadline, plus loading and saving the
+# pinger.  gunicorn's default 30s would kill it halfway through.
+timeout = Config.SWEEP_DEADLINE + Config.CHECK_RECHECK + 30
+
+
+def on_starting(server):
+    import metrics
+    metrics.reset()
+
+
+def child_exit(server, worker):
+    import metrics
+    metrics.process_dead(worker.pid)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+import json
+from datetime import datetime
+from datetime import timedelta
+from flask import current_app as app
+
+import models
+
+__version__ = '1.0'
+
+FIELDS = ('name', 'start', 'stop', 'n', 'response')
+
+
+def day_of(ts):
+    # partition key for models.DayIndex
+    return datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d')
+
+
+def cache_key():
+    return f'{app.config["YAML"].url}:incidents'
+
+
+def version_key():
+    return f'{app.config["YAML"].url}:incidents:version'
+
+
+def version():
+    """
+    Bumped every time an incident is written.  Anything derived
+    from the incident history can key its own cache on this.
+    """
+
+    v = app.redis.get(version_key())
+    return int(v) if v else 0
+
+
+def invalidate():
+    # called by services.Incident.persist() after the dynamodb write
+    pipe = app.redis.pipeline(transaction=False)
+    pipe.delete(cache_key())
+    pipe.incr(version_key())
+    pipe.execute()
+
+
+def query(limit, days):
+    """
+    Newest first, walking back one day partition at a time until
+    we have limit incidents or run out of days.  Each day is a
+    single bounded query against the day-index.
+    """
+
+    incidents = []
+    today = datetime.utcnow()
+    for d in range(days):
+        day = (today - timedelta(days=d)).strftime('%Y-%m-%d')
+        rows = models.Incident.by_day.query(
+            day,
+            scan_index_forward=False,
+            limit=limit - len(incidents)
+        )
+        for row in rows:
+            incidents.append({f: getattr(row, f) for f in FIELDS})
+        if len(incidents) >= limit:
+            break
+    return incidents
+
+
+def recent(limit=None):
+    """
+    The last few incidents for the homepage.  Served from redis
+    until the next persist() invalidates it, so steady state page
+    views cost no dynamodb reads.
+    """
+
+    limit = limit or app.config['HISTORY_LIMIT']
+    cached = app.redis.get(cache_key())
+    if cached:
+        cached = json.loads(cached)
+        # a smaller list than asked for is fine if that's all there is
+        if cached['limit'] >= limit:
+            return cached['incidents'][:limit]
+
+    incidents = query(limit, app.config['HISTORY_DAYS'])
+    cached = {'limit': limit, 'incidents': incidents}
+    app.redis.set(
+        cache_key(),
+        json.dumps(cached),
+        ex=app.config['HISTORY_CACHE_TTL']
+    )
+    return incidents
+
+
+def backfill():
+    """
+    Rows written before the day-index existed have no day and are
+    invisible to query().  One-off scan to fill them in.
+    """
+
+    n = 0
+    for row in models.Incident.scan(models.Incident.day.does_not_exist()):
+        if row.stop is None:
+            continue
+        row.update(actions=[models.Incident.day.set(day_of(row.stop))])
+        n += 1
+    invalidate()
+    return n
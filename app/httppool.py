@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app as app
+
+__version__ = '1.0'
+
+_session = None
+_lock = threading.Lock()
+
+
+def get_session():
+    """
+    One requests.Session per worker process.  It outlives the
+    sweep so keep-alive connections (one urllib3 pool per host)
+    get reused by the next sweep instead of paying for a new
+    tcp handshake and tls negotiation every time.
+    """
+
+    global _session
+    with _lock:
+        if _session is None:
+            adapter = HTTPAdapter(
+                pool_connections=app.config['HTTP_POOL_CONNECTIONS'],
+                pool_maxsize=app.config['HTTP_POOL_MAXSIZE'],
+                max_retries=0
+            )
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+def close_session():
+    # mostly for tests and the config reloader
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Multiping - ping every ICMP service at once from a single socket.
+
+Uses an unprivileged datagram ICMP socket, so no root and no forking
+/bin/ping.  On some Linux systems, you must allow this feature:
+
+$ echo 'net.ipv4.ping_group_range = 0 2147483647' | sudo
+    tee -a /etc/sysctl.conf
+$ sudo sysctl -p
+
+You can check the current value with the following command:
+
+$ sysctl net.ipv4.ping_group_range
+net.ipv4.ping_group_range = 0 2147483647
+"""
+
+import os
+import time
+import struct
+import socket
+import select
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+__version__ = '1.1'
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+HEADER = struct.Struct('!BBHHH')
+# the echo sequence number is 16 bits
+SEQ_MAX = 0x10000
+RESOLVERS = 16
+
+_available = None
+
+
+def checksum(data):
+    # rfc 1071 internet checksum
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def echo_request(ident, seq, payload=b'pyping'):
+    header = HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    csum = checksum(header + payload)
+    header = HEADER.pack(ICMP_ECHO_REQUEST, 0, csum, ident, seq)
+    return header + payload
+
+
+def open_socket():
+    # raises PermissionError when ping_group_range doesn't include us
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+    s.setblocking(False)
+    return s
+
+
+def available():
+    """
+    Can we open a datagram ICMP socket here?  Only asks the
+    kernel once per process.
+    """
+
+    global _available
+    if _available is None:
+        try:
+            open_socket().close()
+            _available = True
+        except OSError:
+            _available = False
+    return _available
+
+
+def resolve(hosts, timeout):
+    """
+    Look every name up at once in a few threads, gethostbyname()
+    has no timeout of its own and one dead resolver mustn't eat
+    the whole batch one host at a time.  Ips skip the lookup.
+
+    @return - dict() - {host: ip}, hosts that didn't resolve in
+    time (or at all) are left out.
+    """
+
+    addrs = {}
+    names = set()
+    for host in hosts:
+        try:
+            socket.inet_aton(host)
+            addrs[host] = host
+        except OSError:
+            names.add(host)
+    if not names:
+        return addrs
+
+    pool = ThreadPoolExecutor(
+        max_workers=min(RESOLVERS, len(names)),
+        thread_name_prefix='icmp-resolve'
+    )
+    futures = {pool.submit(socket.gethostbyname, n): n for n in names}
+    done, _ = wait(futures, timeout=timeout)
+    # lookups still stuck are left to finish (or not) on their own
+    pool.shutdown(wait=False, cancel_futures=True)
+    for f in done:
+        if f.exception() is None:
+            addrs[futures[f]] = f.result()
+    return addrs
+
+
+def multiping(hosts, timeout):
+    """
+    Send one echo request to every host, then collect replies
+    until they are all in or the timeout runs out.  The sequence
+    number is 16 bits, so every SEQ_MAX hosts get a socket of
+    their own.
+
+    @params - hosts - list of hostnames or ips, may repeat
+    @params - timeout - seconds to wait for the whole batch
+
+    @return - list() - rtt in ms for each host (same order), or
+    None when the host didn't answer.  Raises OSError when
+    the socket can't be opened, the caller should fall back to
+    the ping binary.
+    """
+
+    rtts = [None] * len(hosts)
+    addrs = resolve(hosts, timeout)
+    socks = []
+    # (socket, seq) -> (host index, addr, sent at), until it answers
+    pending = {}
+
+    try:
+        # the kernel rewrites the identifier to the socket's "port",
+        # we still set our own in case this is a raw socket one day
+        ident = os.getpid() & 0xffff
+        idents = {}
+
+        for i, host in enumerate(hosts):
+            seq = i % SEQ_MAX
+            if seq == 0:
+                sock = open_socket()
+                socks.append(sock)
+                idents[sock] = (ident, sock.getsockname()[1])
+            addr = addrs.get(host)
+            if addr is None:
+                continue
+            try:
+                sock.sendto(echo_request(ident, seq), (addr, 0))
+            except OSError:
+                continue
+            pending[sock, seq] = (i, addr, time.monotonic())
+
+        deadline = time.monotonic() + timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select(socks, [], [], remaining)
+            if not readable:
+                break
+            for sock in readable:
+                try:
+                    data, (addr, _) = sock.recvfrom(1024)
+                except BlockingIOError:
+                    continue
+                now = time.monotonic()
+                if len(data) < HEADER.size:
+                    continue
+                kind, _, _, r_ident, seq = HEADER.unpack_from(data)
+                if kind != ICMP_ECHO_REPLY or r_ident not in idents[sock]:
+                    continue
+                sent = pending.get((sock, seq))
+                if sent is None or sent[1] != addr:
+                    continue
+                del pending[sock, seq]
+                rtts[sent[0]] = (now - sent[2]) * 1000
+    finally:
+        for sock in socks:
+            sock.close()
+
+    return rtts
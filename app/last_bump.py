@@ -20,6 +20,7 @@ __version__ = '0.2.10'
 version = ERROR_VERSION
 hexdigest = ERROR_HASH
 
+js = {}
 try:
     with open(DEFAULT_FILE) as f:
         js = json.load(f)
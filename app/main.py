@@ -8,8 +8,8 @@
 # --------------------------------------------------------------------------
 
 import os
+import time
 import logging
-import pickle
 import importlib
 from datetime import datetime
 
@@ -22,6 +22,16 @@ import app_config
 import notification
 import services
 import models
+import sweep
+import state
+import history
+import pagecache
+import timeseries
+import cluster
+import api
+import siteconfig
+import metrics
+import tracing
 
 from last_bump import version as __version__
 __app_name__ = 'pyping'
@@ -35,6 +45,10 @@ app.config['APP_NAME'] = __app_name__
 app.config['APP_VERSION'] = __version__
 
 app.redis = Redis.from_url(app.config['REDIS_URL'])
+app.config['SITE_VERSION'] = siteconfig.version(app.config['YAML'])
+watcher = None
+if app.config['CONFIG_RELOAD']:
+    watcher = siteconfig.Watcher(poll=app.config['CONFIG_POLL'])
 
 logging.basicConfig(
     format=app.config['LOG_FORMAT'],
@@ -53,6 +67,12 @@ app.logger.info('--------------------------------------')
 app.logger.info(f'imported app_config v{ app_config.__version__ }')
 app.logger.info(f'imported services v{ services.__version__ }')
 app.logger.info(f'imported notification v{ notification.__version__ }')
+app.logger.info(f'imported sweep v{ sweep.__version__ }')
+app.logger.info(f'imported state v{ state.__version__ }')
+app.logger.info(f'imported history v{ history.__version__ }')
+app.logger.info(f'imported pagecache v{ pagecache.__version__ }')
+app.logger.info(f'imported metrics v{ metrics.__version__ }')
+app.logger.info(f'imported tracing v{ tracing.__version__ }')
 app.logger.info('--------------------------------------')
 app.logger.info(f'redis module v{ ver["redis_version"] }')
 app.logger.info('--------------------------------------')
@@ -67,6 +87,21 @@ app.logger.info('======================================')
 ############################################
 
 
+@app.before_request
+def reload_config():
+    """
+    Pick up site.yml edits, a stat() every CONFIG_POLL seconds at
+    most.  Pinger is built from the config on every load, so the
+    next one already sees the new services.
+    """
+
+    if watcher is None:
+        return
+    yaml = watcher.changed()
+    if yaml is not None:
+        siteconfig.apply(yaml, Pinger.store())
+
+
 @app.template_filter('fmt_timestamp')
 def fmt_timestamp(ts=None):
     """
@@ -112,8 +147,35 @@ def index():
     (hopefully) results.
     """
 
-    p = Pinger.load()
-    i = models.Incident.scan()
+    _, updated = Pinger.store().load_meta()
+    tag = index_etag(updated)
+    if pagecache.not_modified(tag):
+        return pagecache.respond_304(tag, updated)
+
+    bodies = pagecache.get('index', tag)
+    if bodies is None:
+        bodies = pagecache.put('index', tag, render_index())
+    return pagecache.respond(bodies, tag, updated)
+
+
+def index_etag(updated):
+    """
+    The homepage only changes when a sweep saves, an incident is
+    written, site.yml changes, or the "Last check" text ticks over.
+    """
+
+    if updated:
+        ago = Pinger.how_long_ago(datetime.fromtimestamp(updated))
+    else:
+        ago = Pinger.how_long_ago(None)
+    return pagecache.etag(updated, history.version(), ago, __version__,
+                          app.config['SITE_VERSION'])
+
+
+def render_index():
+    # the page only needs up/down, skip the incident details
+    p = Pinger.load(fields=['alive'])
+    i = history.recent()
     return render_template('index.html', pinger=p, incidents=i)
 
 
@@ -126,14 +188,153 @@ def cron():
     insert details into dynamodb.
     """
 
-    p = Pinger.load()
-    for s in p.services:
-        s.check()
-
-    p.save()
+    if app.config['CLUSTER']:
+        # several nodes may get the same cron, one sweep is plenty
+        c = Pinger.cluster()
+        if not c.lead(ttl=app.config['SWEEP_DEADLINE'], lock='cron'):
+            app.logger.info(f'{c.leader("cron")} is sweeping, skipping')
+            return '<html>cron skipped, not the leader</html>'
+
+    profile = request.args.get('profile', 0, type=int)
+    profile = profile or app.config['PROFILE']
+    with tracing.Trace('cron', profile, app.config['PROFILE_INTERVAL']) as t:
+        with tracing.span('load'):
+            p = Pinger.load()
+        ts = time.monotonic()
+        sweeper = sweep.Sweeper()
+        with tracing.span('sweep'):
+            sweeper.run(p.services)
+        # second strike for anything that just went down
+        with tracing.span('confirm'):
+            sweeper.confirm(p.services, started=ts)
+
+        with tracing.span('save'):
+            p.save()
+
+        # pre-build the homepage so the first visitor doesn't have to
+        with tracing.span('pagecache'):
+            _, updated = Pinger.store().load_meta()
+            pagecache.put('index', index_etag(updated), render_index())
+    if app.config['TRACE'] or profile:
+        tracing.save(app.redis, app.config['YAML'].url, t,
+                     app.config['TRACE_KEEP'])
     return '<html>cron complete</html>'
 
 
+@app.route("/_latency/<name>")
+def latency(name):
+    """
+    Latency history for one service.  ?tier=raw|1m|1h|1d and
+    ?since=<unix ts>, rollups have min/avg/p95/max in ms.
+    """
+
+    tier = request.args.get('tier', '1h')
+    since = request.args.get('since', 0, type=int)
+    series = Pinger.store().series
+    if tier == 'raw':
+        rows = series.raw(name, since)
+    elif tier in [t[0] for t in timeseries.TIERS]:
+        rows = series.rollups(name, tier, since)
+    else:
+        return {'error': f'unknown tier {tier}'}, 400
+    return {'name': name, 'tier': tier, 'samples': rows}, 200
+
+
+@app.route("/_uptime")
+def uptime():
+    """
+    Availability per service and per group over 24h/7d/30d/90d,
+    see sla.py.
+    """
+
+    # numpy is a tenth of a second of import, only this page pays it
+    import sla
+
+    return sla.uptime(), 200
+
+
+@app.route("/_trace")
+def trace_recent():
+    """
+    Per phase timings of the last sweeps, newest first, see
+    tracing.py.  ?name=cron|scheduler and ?n=<how many>.
+    """
+
+    name = request.args.get('name', 'cron')
+    n = request.args.get('n', 1, type=int)
+    traces = tracing.recent(app.redis, app.config['YAML'].url, name, n)
+    for t in traces:
+        # the stacks can be big, they have their own endpoint
+        t['profile'] = t['profile'] is not None
+    return {'name': name, 'traces': traces}, 200
+
+
+@app.route("/_trace/profile")
+def trace_profile():
+    """
+    Collapsed stacks of the newest profiled sweep, feed it to
+    flamegraph.pl or drop it on speedscope.app.  Run a sweep
+    with /_cron?profile=1 first.
+    """
+
+    name = request.args.get('name', 'cron')
+    traces = tracing.recent(
+        app.redis, app.config['YAML'].url, name, app.config['TRACE_KEEP'])
+    for t in traces:
+        if t['profile']:
+            return t['profile'], 200, {'Content-Type': 'text/plain'}
+    return {'error': f'no profiled {name} sweep yet'}, 404
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """
+    Prometheus scrape, see metrics.py.  Only reads the counters
+    the checks already keep, no redis and no Pinger.load().
+    """
+
+    scrape = metrics.render()
+    if scrape is None:
+        return {'error': 'prometheus_client is not installed'}, 501
+    body, content_type = scrape
+    return body, 200, {'Content-Type': content_type}
+
+
+@app.cli.command('create-tables')
+def create_tables():
+    """
+    Provision the dynamodb table, once per deploy.  Also adds the
+    day index to a table from before it existed.
+        $ flask create-tables
+    """
+
+    table = models.Incident.Meta.table_name
+    if models.create_tables():
+        print(f'created {table}')
+    elif models.add_day_index():
+        print(f'added {models.DayIndex.Meta.index_name} to {table}, '
+              'now run flask backfill-history')
+    else:
+        print(f'{table} already exists')
+
+
+@app.cli.command('backfill-history')
+def backfill_history():
+    """
+    One-off: tag incidents written before the day-index existed
+    so they show up on the homepage again.
+        $ flask backfill-history
+    """
+
+    if not models.has_day_index():
+        print(f'{models.Incident.Meta.table_name} has no '
+              f'{models.DayIndex.Meta.index_name}, run flask create-tables '
+              'first')
+        return
+    n = history.backfill()
+    print(f'backfilled {n} incidents')
+
+
 @app.route("/_health/<patient>")
 def healthcheck(patient='vagrant'):
     """
@@ -146,6 +347,19 @@ def healthcheck(patient='vagrant'):
     return {'success': True}, 200    # will be returned with jsonify
 
 
+@app.route("/_cluster")
+def cluster_status():
+    """
+    Live checker nodes, the leader and how many services each
+    node owns.  Only meaningful with cluster: true.
+    """
+
+    names = [svc['name'] for svc in app.config['YAML'].services]
+    status = Pinger.cluster().status(names)
+    del status['node']
+    return status, 200
+
+
 @app.route("/_test")
 def tester():
     """
@@ -178,6 +392,53 @@ def all_env():
     return str(os.environ)
 
 
+@app.route("/api/v1/status")
+def api_status():
+    """
+    Machine readable status, built on Service.to_dict().  See
+    api.parse_query() for filters, fields and paging.  Send
+    Accept: application/msgpack (or ?format=msgpack) for msgpack.
+    """
+
+    store = Pinger.store()
+    _, updated = store.load_meta()
+    tag = pagecache.etag(
+        updated, request.query_string, request.accept_mimetypes,
+        api.API_VERSION, app.config['SITE_VERSION'])
+    if pagecache.not_modified(tag):
+        return api.respond_304(pagecache.headers(tag, updated))
+
+    try:
+        q = api.parse_query(request.args, app.config['API_PER_PAGE'])
+    except api.BadRequest as e:
+        return api.error(str(e))
+
+    # filter on config first, then on the cheapest state we can
+    p = Pinger()
+    svcs = p.services
+    if q['service_type']:
+        svcs = [s for s in svcs if s.service_type in q['service_type']]
+    if q['alive'] is not None:
+        p.hydrate(svcs, ['alive'], store)
+        svcs = [s for s in svcs if s.is_alive == q['alive']]
+
+    total = len(svcs)
+    svcs = api.paginate(svcs, q['page'], q['per_page'])
+    if updated:
+        p.hydrate(svcs, None, store)
+
+    payload = {
+        'api': api.API_VERSION,
+        'version': __version__,
+        'updated': updated,
+        'total': total,
+        'page': q['page'],
+        'per_page': q['per_page'],
+        'services': [api.sparse(s.to_dict(), q['fields']) for s in svcs],
+    }
+    return api.respond(payload, pagecache.headers(tag, updated))
+
+
 @app.route("/_dump")
 def dump_pinger():
     """
@@ -220,8 +481,10 @@ def dump_pinger():
 
 class Pinger:
     """
-    Pinger object we can cache in Redis so the website
-    can run without having to do it's own checks.
+    Pinger object whose state we keep in Redis so the website
+    can run without having to do it's own checks.  Services are
+    always built from the config, only their live state comes
+    from the cache - see state.py.
     """
 
     def __init__(self):
@@ -232,19 +495,69 @@ class Pinger:
         """
 
         services = app.config['YAML'].services
-        self.updated = datetime.now()
+        self.updated = None
         self.created = datetime.now()
         self._services = []
+        self.fingerprints = {}
         for svc in services:
-            app.logger.debug('loading: {}-{}'.format(
-                svc.get('name'), svc.get('service_type')))
+            self._services.append(self.build(svc))
+            self.fingerprints[svc['name']] = siteconfig.fingerprint(svc)
+
+    @staticmethod
+    def build(svc):
+        # one service object from its site.yml entry
+        app.logger.debug('loading: {}-{}'.format(
+            svc.get('name'), svc.get('service_type')))
+
+        module = importlib.import_module('services')
+        klass_name = svc.get('service_type').upper()
+        klass = getattr(module, klass_name)
+        return klass(**svc)
 
-            module = importlib.import_module('services')
-            klass_name = svc.get('service_type').upper()
-            klass = getattr(module, klass_name)
-            instance = klass(**svc)
+    def reload(self):
+        """
+        Bring a long lived Pinger in line with app.config['YAML']
+        (see siteconfig.py).  Unchanged services are kept as they
+        are, edited ones are rebuilt and adopt the old one's live
+        state, removed ones go away.  Returns (added, removed,
+        changed) lists of service objects, removed ones being the
+        old objects.
+        """
 
-            self._services.append(instance)
+        current = {svc.name: svc for svc in self._services}
+        new = siteconfig.fingerprints(app.config['YAML'])
+        added, removed, changed = siteconfig.diff(self.fingerprints, new)
+
+        services = []
+        for definition in app.config['YAML'].services:
+            name = definition['name']
+            if name in added or name in changed:
+                svc = self.build(definition)
+                if name in changed:
+                    svc.adopt(current[name])
+            else:
+                svc = current[name]
+            services.append(svc)
+
+        self._services = services
+        self.fingerprints = new
+        by_name = {svc.name: svc for svc in services}
+        return ([by_name[n] for n in added],
+                [current[n] for n in removed],
+                [by_name[n] for n in changed])
+
+    @staticmethod
+    def store():
+        return state.StateStore(app.redis, app.config['YAML'].url)
+
+    @staticmethod
+    def cluster():
+        return cluster.Cluster(
+            app.redis,
+            app.config['YAML'].url,
+            ttl=app.config['CLUSTER_NODE_TTL'],
+            vnodes=app.config['CLUSTER_VNODES']
+        )
 
     @property
     def services(self):
@@ -288,10 +601,16 @@ class Pinger:
         just now...
         """
 
-        if not self.updated:
+        return self.how_long_ago(self.updated)
+
+    @staticmethod
+    def how_long_ago(updated):
+        # the guts of long_ago, usable without loading a Pinger
+
+        if not updated:
             return 'Never?'
         now = datetime.now()
-        elapsed_time = now - self.updated
+        elapsed_time = now - updated
         secs = elapsed_time.total_seconds()
 
         if secs > 1200:
@@ -317,44 +636,51 @@ class Pinger:
             return 'just now'
         return elapsed_time.total_seconds()
 
-    def serialize(self):
+    def save(self, force=False):
         """
-        Prepare the object to be stored in
-        Redis.
-        """
-
-        return pickle.dumps(self)
-
-    def save(self):
-        """
-        After check, serialize cache and save to Redis.
-        This way the website can load aoo data without
-        having to re-check sites itself.
+        After check, write each checked service's state to Redis.
+        This way the website can load all data without having to
+        re-check sites itself.
         """
 
         app.logger.info('SAVING cache now!')
         self.updated = datetime.now()
-        app.redis.set(app.config['YAML'].url, self.serialize())
+        n = self.store().save(self._services, force=force)
+        app.logger.debug(f'saved state for {n} services')
 
     @classmethod
-    def load(cls):
+    def load(cls, fields=None):
         """
-        Attempt to fetch results from cache.
-        If cache is a MISS, load the initial
-        data from file.
+        Build the services from config, then attempt to fetch
+        their state from cache.  Pass fields to only pull the
+        bits you need, see state.FIELDS.  If the cache is a
+        MISS the services keep their fresh from file state.
         """
 
-        cache = app.redis.get(app.config['YAML'].url)
-        if cache:
-            # Load from CACHE
-            app.logger.info('cache HIT! Loading from cache.')
-            return pickle.loads(cache)
-        else:
-            # Load from FILE
+        p = Pinger()
+        store = cls.store()
+        created, updated = store.load_meta()
+        if updated is None:
             app.logger.info('cache MISS. Loading from file.')
-            p = Pinger()
             return p
 
+        app.logger.info('cache HIT! Loading from cache.')
+        p.created = datetime.fromtimestamp(created)
+        p.updated = datetime.fromtimestamp(updated)
+        p.hydrate(p.services, fields, store)
+        return p
+
+    def hydrate(self, services, fields=None, store=None):
+        """
+        Restore cached state into just some of our services, for
+        callers that filter before they need the details.
+        """
+
+        store = store or self.store()
+        states = store.load(services, fields)
+        for svc, s in zip(services, states):
+            svc.restore(s)
+
 
 ############################################
 
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Prometheus metrics for GET /metrics.  Plain in-process counters and
+histograms, bumped where the work happens - a scrape only reads them
+back, it never loads the pinger or touches redis.
+
+Each gunicorn worker has its own copies.  With PROMETHEUS_MULTIPROC_DIR
+set (the Dockerfile does) they live in small mmap'd files there and
+are summed on scrape, see gunicorn.conf.py.  Mount the same directory
+into the scheduler and notifier containers and their numbers show up
+in the same scrape.
+"""
+
+import os
+import glob
+import time
+import socket
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+    from prometheus_client import values
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+__version__ = '1.0'
+
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+HOST = socket.gethostname()
+
+# icmp answers in a millisecond, a dead tcp port takes the whole timeout
+CHECK_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+SWEEP_BUCKETS = (.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 120)
+REDIS_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def ident(pid=None):
+    # containers sharing the directory are all pid 1, so add the host
+    return f'{HOST}-{pid or os.getpid()}'
+
+
+if prometheus_client is not None:
+    if MULTIPROC_DIR:
+        values.ValueClass = values.MultiProcessValue(ident)
+
+    LABELS = ['service_type', 'service']
+    CHECK_SECONDS = prometheus_client.Histogram(
+        'pyping_check_duration_seconds',
+        'Time taken by one service check',
+        LABELS, buckets=CHECK_BUCKETS)
+    SERVICE_UP = prometheus_client.Gauge(
+        'pyping_service_up',
+        '1 if the service passed its last check',
+        LABELS, multiprocess_mode='mostrecent')
+    FAILURES = prometheus_client.Gauge(
+        'pyping_consecutive_failures',
+        'Failed checks in a row (the open incident n)',
+        LABELS, multiprocess_mode='mostrecent')
+    SWEEP_SECONDS = prometheus_client.Histogram(
+        'pyping_sweep_duration_seconds',
+        'Wall time of one sweep over all services',
+        buckets=SWEEP_BUCKETS)
+    SWEEP_LATE = prometheus_client.Counter(
+        'pyping_sweep_late',
+        'Checks that missed the sweep deadline')
+    STATE_SECONDS = prometheus_client.Histogram(
+        'pyping_state_seconds',
+        'Redis state store load/save latency',
+        ['op'], buckets=REDIS_BUCKETS)
+    STATE_BYTES = prometheus_client.Histogram(
+        'pyping_state_save_bytes',
+        'Service state written to redis per save',
+        buckets=BYTES_BUCKETS)
+    PERSIST_SECONDS = prometheus_client.Histogram(
+        'pyping_dynamodb_persist_seconds',
+        'Writing one finished incident to dynamodb')
+    NOTIFY_SECONDS = prometheus_client.Histogram(
+        'pyping_notification_send_seconds',
+        'Sending one notification',
+        ['transport'])
+else:
+    CHECK_SECONDS = SERVICE_UP = FAILURES = None
+    SWEEP_SECONDS = SWEEP_LATE = None
+    STATE_SECONDS = STATE_BYTES = None
+    PERSIST_SECONDS = NOTIFY_SECONDS = None
+
+
+@contextmanager
+def timed(metric, **labels):
+    """
+    Observe how long the with block took, in seconds.  Also when
+    it raises, a failed smtp send still took its time.
+    """
+
+    if metric is None:
+        yield
+        return
+    if labels:
+        metric = metric.labels(**labels)
+    ts = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric.observe(time.perf_counter() - ts)
+
+
+def observe(metric, value, **labels):
+    if metric is None:
+        return
+    if labels:
+        metric = metric.labels(**labels)
+    metric.observe(value)
+
+
+def check(svc):
+    # one settled check, called from Service.settle()
+    if prometheus_client is None:
+        return
+    labels = (svc.service_type, svc.name)
+    if svc.elapsed_ms is not None:
+        CHECK_SECONDS.labels(*labels).observe(svc.elapsed_ms / 1000)
+    SERVICE_UP.labels(*labels).set(1 if svc.is_alive else 0)
+    FAILURES.labels(*labels).set(svc.incident.n if svc.incident else 0)
+
+
+def sweep(elapsed, late):
+    if prometheus_client is None:
+        return
+    SWEEP_SECONDS.observe(elapsed)
+    SWEEP_LATE.inc(late)
+
+
+def render():
+    """
+    @return - tuple() - (body, content type) for the scrape, None
+    when prometheus_client isn't installed.
+    """
+
+    if prometheus_client is None:
+        return None
+    if MULTIPROC_DIR:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    body = prometheus_client.generate_latest(registry)
+    return body, prometheus_client.CONTENT_TYPE_LATEST
+
+
+def reset():
+    """
+    Forget this host's files from before a restart, at startup.
+    Other containers sharing the directory keep theirs, and so do
+    we - importing this module already opened ours.
+    """
+
+    if not MULTIPROC_DIR:
+        return
+    mine = f'_{ident()}.db'
+    for f in glob.glob(os.path.join(MULTIPROC_DIR, f'*_{HOST}-*.db')):
+        if not f.endswith(mine):
+            os.remove(f)
+
+
+def process_dead(pid):
+    # a gunicorn worker exited, its live gauges go with it
+    if prometheus_client is None or not MULTIPROC_DIR:
+        return
+    multiprocess.mark_process_dead(ident(pid), MULTIPROC_DIR)
@@ -8,11 +8,14 @@
 # --------------------------------------------------------------------------
 
 import os
+import time
 from uuid import uuid4
 from datetime import datetime
 from flask import current_app as app
 
 from pynamodb.models import Model
+from pynamodb.indexes import GlobalSecondaryIndex
+from pynamodb.indexes import AllProjection
 from pynamodb.attributes import UnicodeAttribute
 from pynamodb.attributes import NumberAttribute
 from pynamodb.attributes import UnicodeAttribute
@@ -23,17 +26,35 @@ from pynamodb_attributes import UUIDAttribute
 
 unique_key = 'incidents-local'
 
+
+class DayIndex(GlobalSecondaryIndex):
+    """
+    Incidents by the (utc) day they ended, newest first.  Lets the
+    homepage query a few days instead of scanning the table.
+    """
+    class Meta:
+        index_name = 'day-index'
+        write_capacity_units = 2
+        read_capacity_units = 2
+        projection = AllProjection()
+
+    day = UnicodeAttribute(hash_key=True)
+    stop = NumberAttribute(range_key=True)
+
+
 class Incident(Model):
     class Meta:
         aws_access_key_id = os.environ.get('AWS_ACCESS_KEY_ID')
         aws_secret_access_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
         region = os.environ.get('AWS_DEFAULT_REGION')
+        # DynamoDB Local or another stand-in, unset means aws itself
+        host = os.environ.get('DYNAMODB_HOST')
         write_capacity_units = 2
         read_capacity_units = 2
         table_name = 'pyping-local'
-        __version__ = '1.0'
+        __version__ = '1.1'
 
-    __id__ = UUIDAttribute(hash_key=True, default=uuid4())
+    __id__ = UUIDAttribute(hash_key=True, default=uuid4)
     __created_at__ = UTCDateTimeAttribute(range_key=True, default=datetime.now)
     __version__ = UnicodeAttribute(null=True, default=Meta.__version__)
     __writes__ = VersionAttribute()
@@ -42,6 +63,70 @@ class Incident(Model):
     stop = NumberAttribute(null=True)
     n = NumberAttribute(null=True)
     name = UnicodeAttribute(null=True)
+    day = UnicodeAttribute(null=True)
+    by_day = DayIndex()
+
 
-if not Incident.exists():
+def create_tables():
+    """
+    Create the table (and its index) if it isn't there yet.  Not
+    done at import any more, every worker boot paid for a dynamodb
+    round trip - run `flask create-tables` once instead.  Returns
+    True if the table had to be created, see add_day_index() for
+    older tables.
+    """
+
+    if Incident.exists():
+        return False
     Incident.create_table(wait=True)
+    return True
+
+
+def has_day_index():
+    table = Incident._get_connection().describe_table()
+    names = [i['IndexName'] for i in table.get('GlobalSecondaryIndexes', [])]
+    return DayIndex.Meta.index_name in names
+
+
+def add_day_index(wait=True):
+    """
+    Tables created before DayIndex don't get it from create_table(),
+    add it with an UpdateTable.  pynamodb's own update_table() can
+    only change an index's capacity, so this goes straight to the
+    botocore client.  Returns True if the index had to be added.
+    """
+
+    if has_day_index():
+        return False
+    meta = DayIndex.Meta
+    client = Incident._get_connection().connection.client
+    client.update_table(
+        TableName=Incident.Meta.table_name,
+        AttributeDefinitions=[
+            {'AttributeName': 'day', 'AttributeType': 'S'},
+            {'AttributeName': 'stop', 'AttributeType': 'N'},
+        ],
+        GlobalSecondaryIndexUpdates=[{'Create': {
+            'IndexName': meta.index_name,
+            'KeySchema': [
+                {'AttributeName': 'day', 'KeyType': 'HASH'},
+                {'AttributeName': 'stop', 'KeyType': 'RANGE'},
+            ],
+            'Projection': {'ProjectionType': 'ALL'},
+            'ProvisionedThroughput': {
+                'ReadCapacityUnits': meta.read_capacity_units,
+                'WriteCapacityUnits': meta.write_capacity_units,
+            },
+        }}],
+    )
+    while wait and not day_index_active():
+        time.sleep(2)
+    return True
+
+
+def day_index_active():
+    table = Incident._get_connection().describe_table()
+    for index in table.get('GlobalSecondaryIndexes', []):
+        if index['IndexName'] == DayIndex.Meta.index_name:
+            return index.get('IndexStatus') == 'ACTIVE'
+    return False
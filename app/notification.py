@@ -7,13 +7,46 @@
 #  Author: Jamie Hopper <jh@mode14.com>
 # --------------------------------------------------------------------------
 
+import json
+import time
 import smtplib
 from email.message import EmailMessage
 from flask import current_app as app
 from twilio.rest import Client
 
+import metrics
+import tracing
 
-__version__ = '1.7'
+__version__ = '2.0'
+
+
+############################################
+
+
+def queue_key():
+    return f'{app.config["YAML"].url}:notify'
+
+
+def retry_key():
+    return f'{app.config["YAML"].url}:notify:retry'
+
+
+def enqueue(subject, body, kind='msg', only=None, attempts=0):
+    """
+    Push a notification for notifier.py to send, so a slow smtp
+    server never holds up the sweep.  only= restricts delivery to
+    one subscriber destination, used when retrying.
+    """
+
+    event = {
+        'kind': kind,
+        'subject': subject,
+        'body': body,
+        'ts': time.time(),
+        'only': only,
+        'attempts': attempts,
+    }
+    app.redis.rpush(queue_key(), json.dumps(event))
 
 
 ############################################
@@ -25,6 +58,8 @@ class Notification:
         # Read in our subscribers
         app.logger.debug('reading in subscribers')
         self.subscribers = app.config['YAML'].get('subscribers', [])
+        self.subject = subject
+        self.body = body
         self.transports = []
 
         for sub in self.subscribers:
@@ -43,6 +78,13 @@ class Notification:
         for transport in self.transports:
             transport._send()
 
+    def queue(self, kind='msg'):
+        """ Hand off to the notifier worker, or send now if disabled """
+        with tracing.span(self.subject, 'notify'):
+            if not app.config['NOTIFY_QUEUE']:
+                return self.send()
+            enqueue(self.subject, self.body, kind)
+
 
 class Email:
     def __init__(self, subject, body, sub):
@@ -66,8 +108,16 @@ class Email:
             self.body = body
             self.sub = sub
 
-    def _send(self):
-        """ Sends via email """
+    def connect(self):
+        """ Open (and log in to) the smtp server, caller closes it """
+        server = smtplib.SMTP(self.smtp_host, self.smtp_port)
+        server.starttls()
+        if self.smtp_user:
+            server.login(self.smtp_user, self.smtp_pass)
+        return server
+
+    def _send(self, server=None):
+        """ Sends via email, reusing server if we're given one """
         app.logger.info(
             'Sending notification via email for {}'.format(
                 self.sub.destination)
@@ -78,12 +128,14 @@ class Email:
         msg['To'] = self.sub.destination
         msg.set_content(self.body)
 
-        with smtplib.SMTP(self.smtp_host, self.smtp_port) as server:
-            server.starttls()
-            if self.smtp_user:
-                server.login(self.smtp_user, self.smtp_pass)
-            server.send_message(msg)
-            return server
+        with metrics.timed(metrics.NOTIFY_SECONDS, transport='email'):
+            if server is not None:
+                server.send_message(msg)
+                return server
+
+            with self.connect() as server:
+                server.send_message(msg)
+                return server
 
 
 class Twilio:
@@ -98,15 +150,20 @@ class Twilio:
             self.body = body
             self.sub = sub
 
-    def _send(self):
-        """ Sends via Twilio """
+    def connect(self):
+        return Client(self.twilio_account_sid, self.twilio_auth_token)
+
+    def _send(self, client=None):
+        """ Sends via Twilio, reusing client if we're given one """
         app.logger.info(
             'Sending notification via twilio for {}'.format(
                 self.sub.destination)
         )
-        client = Client(self.twilio_account_sid, self.twilio_auth_token)
-        message = client.messages.create(
-          body=self.body,
-          messaging_service_sid=self.twilio_messaging_service_sid,
-          to=self.sub.destination)
+        with metrics.timed(metrics.NOTIFY_SECONDS, transport='twilio-sms'):
+            if client is None:
+                client = self.connect()
+            message = client.messages.create(
+              body=self.body,
+              messaging_service_sid=self.twilio_messaging_service_sid,
+              to=self.sub.destination)
         return message.sid
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Notification worker.  Drains the queue that Incident.send_down_msg()
+and send_up_msg() push onto, so the sweep never waits on smtp or
+twilio.  Run it next to the web app:
+
+    $ python3 notifier.py
+"""
+
+import json
+import time
+
+import notification
+import metrics
+from main import app
+
+__version__ = '1.1'
+
+
+def take_batch(redis, window, size):
+    """
+    Block for the first event, then give the rest of a burst a
+    few seconds to arrive so a flapping site or a switch taking
+    out ten services becomes one digest instead of ten messages.
+    """
+
+    first = redis.blpop(notification.queue_key(), timeout=30)
+    if first is None:
+        return []
+    events = [json.loads(first[1])]
+
+    deadline = time.monotonic() + window
+    while len(events) < size:
+        raw = redis.lpop(notification.queue_key())
+        if raw is None:
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.5)
+            continue
+        events.append(json.loads(raw))
+    return events
+
+
+def promote_retries(redis):
+    # move retries whose backoff has expired back onto the queue
+    now = time.time()
+    due = redis.zrangebyscore(notification.retry_key(), 0, now)
+    if not due:
+        return
+    pipe = redis.pipeline()
+    pipe.zrem(notification.retry_key(), *due)
+    pipe.rpush(notification.queue_key(), *due)
+    pipe.execute()
+
+
+def digest(events):
+    """
+    Collapse a batch into one (subject, body).  A single event
+    goes out exactly as it was queued.
+    """
+
+    if len(events) == 1:
+        return events[0]['subject'], events[0]['body']
+
+    downs = sum(1 for e in events if e['kind'] == 'down')
+    ups = sum(1 for e in events if e['kind'] == 'up')
+    subject = f'{downs} down, {ups} back up'
+    lines = []
+    for e in events:
+        ts = time.strftime('%H:%M:%S', time.localtime(e['ts']))
+        lines.append(f'{ts}  {e["body"]}')
+    return subject, '\r\n'.join(lines)
+
+
+class Dispatcher:
+    """
+    Sends one batch.  Holds a single smtp connection for every
+    email in the batch and one twilio client for the life of
+    the worker.
+    """
+
+    def __init__(self):
+        self.twilio = None
+        self.smtp = None
+
+    def _smtp(self, transport):
+        if self.smtp is None:
+            self.smtp = transport.connect()
+        return self.smtp
+
+    def _twilio(self, transport):
+        if self.twilio is None:
+            self.twilio = transport.connect()
+        return self.twilio
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except Exception:
+                pass
+            self.smtp = None
+
+    def send(self, events):
+        """
+        Deliver the batch to every subscriber.  Returns a dict of
+        destination -> events that failed, for retry.
+        """
+
+        failed = {}
+        subscribers = app.config['YAML'].get('subscribers', [])
+        for sub in subscribers:
+            dest = str(sub.destination)
+            mine = [e for e in events if e['only'] in (None, dest)]
+            if not mine:
+                continue
+            subject, body = digest(mine)
+            msg = notification.Notification(subject, body)
+            for transport in msg.transports:
+                if str(transport.sub.destination) != dest:
+                    continue
+                try:
+                    if isinstance(transport, notification.Email):
+                        transport._send(server=self._smtp(transport))
+                    else:
+                        transport._send(client=self._twilio(transport))
+                except Exception as e:
+                    app.logger.error(f'notify {dest} failed: {e}')
+                    # drop the connection, it may be what broke
+                    self.close()
+                    failed[dest] = mine
+        return failed
+
+
+def retry(redis, failed):
+    """
+    Requeue failed events for just the subscriber that failed,
+    backing off exponentially until NOTIFY_MAX_ATTEMPTS.
+    """
+
+    base = app.config['NOTIFY_BACKOFF']
+    pipe = redis.pipeline()
+    for dest, events in failed.items():
+        for e in events:
+            attempts = e['attempts'] + 1
+            if attempts >= app.config['NOTIFY_MAX_ATTEMPTS']:
+                app.logger.error(f'giving up on {dest}: {e["subject"]}')
+                continue
+            e = dict(e, only=dest, attempts=attempts)
+            due = time.time() + base * 2 ** (attempts - 1)
+            pipe.zadd(notification.retry_key(), {json.dumps(e): due})
+    pipe.execute()
+
+
+def main():
+    app.logger.info(f'notifier v{ __version__ } starting')
+    metrics.reset()
+    dispatcher = Dispatcher()
+    with app.app_context():
+        redis = app.redis
+        while True:
+            promote_retries(redis)
+            events = take_batch(
+                redis,
+                app.config['NOTIFY_COALESCE'],
+                app.config['NOTIFY_BATCH']
+            )
+            if not events:
+                continue
+            if not app.config['SEND_NOTIFICATIONS']:
+                continue
+            app.logger.info(f'sending batch of {len(events)} events')
+            try:
+                failed = dispatcher.send(events)
+            finally:
+                dispatcher.close()
+            if failed:
+                retry(redis, failed)
+
+
+if __name__ == '__main__':
+    main()
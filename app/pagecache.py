@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+import gzip
+import hashlib
+from datetime import datetime
+
+from flask import request
+from flask import Response
+from flask import current_app as app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__version__ = '1.1'
+
+ENCODINGS = ('br', 'gzip', 'identity')
+
+
+def key(page):
+    return f'{app.config["YAML"].url}:page:{page}'
+
+
+def etag(*parts):
+    """
+    Build an etag from whatever the page depends on, e.g. the
+    pinger's updated time and the incident version.
+    """
+
+    raw = ':'.join(str(p) for p in parts)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+
+def not_modified(tag):
+    """
+    Does the browser (or traefik) already have this version?
+    Only If-None-Match counts.  The etag covers more than the
+    pinger's updated time (incidents, the "ago" text, the query),
+    so an If-Modified-Since alone can't tell us that.
+    """
+
+    if request.if_none_match:
+        return request.if_none_match.contains(tag)
+    return False
+
+
+def get(page, tag):
+    """
+    Returns {encoding: body} for the cached page if it was built
+    for this etag, otherwise None.
+    """
+
+    cached = app.redis.hgetall(key(page))
+    if not cached or cached.get(b'etag', b'').decode() != tag:
+        return None
+    bodies = {}
+    for enc in ENCODINGS:
+        body = cached.get(enc.encode())
+        if body is not None:
+            bodies[enc] = body
+    return bodies
+
+
+def put(page, tag, html):
+    """
+    Compress once and keep every encoding next to the etag, so
+    the next few thousand hits are just a redis HGETALL.
+    """
+
+    body = html.encode('utf-8')
+    bodies = {
+        'identity': body,
+        'gzip': gzip.compress(body, compresslevel=6),
+    }
+    if brotli is not None:
+        bodies['br'] = brotli.compress(body)
+
+    mapping = {'etag': tag}
+    mapping.update(bodies)
+    pipe = app.redis.pipeline()
+    pipe.delete(key(page))
+    pipe.hset(key(page), mapping=mapping)
+    pipe.execute()
+    return bodies
+
+
+def headers(tag, updated=None):
+    h = {
+        'ETag': f'"{tag}"',
+        'Cache-Control': 'no-cache',
+        'Vary': 'Accept-Encoding',
+    }
+    if updated is not None:
+        dt = datetime.utcfromtimestamp(updated)
+        h['Last-Modified'] = dt.strftime('%a, %d %b %Y %H:%M:%S GMT')
+    return h
+
+
+def respond(bodies, tag, updated=None):
+    """
+    Pick the best encoding the client accepts and build the
+    response.  no-cache means "always revalidate", which is
+    what gets us the cheap 304s.
+    """
+
+    h = headers(tag, updated)
+    accepted = request.accept_encodings
+    for enc in ENCODINGS:
+        if enc not in bodies:
+            continue
+        if enc == 'identity' or enc in accepted:
+            if enc != 'identity':
+                h['Content-Encoding'] = enc
+            return Response(bodies[enc], headers=h, mimetype='text/html')
+
+
+def respond_304(tag, updated=None):
+    return Response(status=304, headers=headers(tag, updated))
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Long running scheduler, the alternative to curl-ing /_cron every
+five minutes.  Keeps the services in memory, gives each one its
+own interval (+/- jitter) from site.yml, and writes results to the
+state store as they come in.
+
+With cluster: true in site.yml run as many of these as you like,
+each one only checks the services the hash ring gives it and picks
+up a dead node's share on the next heartbeat - see cluster.py.
+Edits to site.yml are picked up without a restart, see siteconfig.py.
+
+    $ NODE_ID=checker-1 python3 scheduler.py
+"""
+
+import time
+import queue
+import heapq
+import random
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import sweep
+import siteconfig
+from main import app
+from main import Pinger
+from main import render_index
+from main import index_etag
+import pagecache
+import metrics
+import tracing
+
+__version__ = '1.6'
+
+
+class Scheduler:
+    """
+    A heap of (due, seq, service).  Every tick pops whatever is
+    due and hands the batch to a worker, which checks it, saves
+    just those services and passes them back to go on the heap
+    with their next due time.  A slow batch doesn't hold up the
+    next tick, up to SCHEDULER_BATCHES run at once.  Services we
+    no longer own (or that a config reload replaced) are dropped as
+    they come off the heap.
+    """
+
+    def __init__(self, pinger):
+        self.pinger = pinger
+        self.store = Pinger.store()
+        self.sweeper = sweep.Sweeper(deadline=app.config['SCHEDULER_DEADLINE'])
+        self.tick = app.config['SCHEDULER_TICK']
+        self.seq = itertools.count()
+        self.heap = []
+        self.queued = set()
+        # batches out with a worker, and the ones back from it
+        self.batches = app.config['SCHEDULER_BATCHES']
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.batches,
+            thread_name_prefix='scheduler'
+        )
+        self.inflight = 0
+        self.finished = queue.SimpleQueue()
+        # tracing keeps one trace per process, see check()
+        self.tracing = threading.Lock()
+        # names out with a worker, and a site.yml waiting on some of them
+        self.checking = set()
+        self.pending = None
+        self.held = set()
+        self.live = {svc.name: svc for svc in pinger.services}
+
+        self.watcher = None
+        if app.config['CONFIG_RELOAD']:
+            self.watcher = siteconfig.Watcher(poll=app.config['CONFIG_POLL'])
+
+        self.cluster = None
+        self.beat = app.config['CLUSTER_HEARTBEAT']
+        self.last_beat = 0
+        self.owned = {svc.name for svc in pinger.services}
+        if app.config['CLUSTER']:
+            self.cluster = Pinger.cluster()
+            self.cluster.heartbeat()
+            self.last_beat = time.time()
+            self.owned = {n for n in self.owned if self.cluster.owns(n)}
+
+        # first run is spread evenly over each service's interval
+        now = time.time()
+        for svc in pinger.services:
+            if svc.name in self.owned:
+                self.push(svc, now + random.uniform(0, svc.interval))
+
+    def push(self, svc, due):
+        self.queued.add(svc)
+        heapq.heappush(self.heap, (due, next(self.seq), svc))
+
+    def due(self, now):
+        batch = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, svc = heapq.heappop(self.heap)
+            self.queued.discard(svc)
+            if svc.name in self.held:
+                # a reload is waiting to replace it, see reload_config()
+                self.push(svc, now + self.tick)
+            elif svc.name in self.owned and self.live.get(svc.name) is svc:
+                batch.append(svc)
+        return batch
+
+    def rebalance(self):
+        """
+        Heartbeat, and when the membership changed work out which
+        services moved to us.  Their state was written by another
+        node, so reload it before taking over and keep to the
+        schedule that node had them on.
+        """
+
+        self.last_beat = time.time()
+        if not self.cluster.heartbeat():
+            return
+        owned = {svc.name for svc in self.pinger.services
+                 if self.cluster.owns(svc.name)}
+        gained = [svc for svc in self.pinger.services
+                  if svc.name in owned and svc.name not in self.owned]
+        app.logger.info(
+            f'cluster is now {len(self.cluster.ring.nodes)} nodes, '
+            f'{len(owned)} services here ({len(gained)} new)'
+        )
+        self.owned = owned
+
+        if gained:
+            for svc in gained:
+                # an incident we held may have been closed elsewhere
+                svc.incident = None
+            self.pinger.hydrate(gained, store=self.store)
+        now = time.time()
+        for svc in gained:
+            if svc in self.queued:
+                continue
+            due = (svc.checked or now) + svc.next_interval()
+            self.push(svc, max(due, now))
+
+    def reload_config(self):
+        """
+        site.yml changed: swap in the new and edited services, keep
+        everything else (and its incidents) as it is.  New services
+        get checked within a few seconds, edited ones keep their
+        schedule but with the new interval.
+
+        An edited or removed service whose check is still out waits
+        for it to come back first, otherwise that late result would
+        be saved over the replacement's state (or bring back a
+        removed one's).  Until then they aren't sent out again.
+        """
+
+        yaml = self.pending or self.watcher.changed()
+        if yaml is None:
+            return
+        _, removed, changed = siteconfig.diff(
+            self.pinger.fingerprints, siteconfig.fingerprints(yaml))
+        self.held = set(removed) | set(changed)
+        if self.held & self.checking:
+            self.pending = yaml
+            return
+        self.pending = None
+        self.held = set()
+        siteconfig.apply(yaml, self.store)
+        added, removed, changed = self.pinger.reload()
+        self.live = {svc.name: svc for svc in self.pinger.services}
+        self.owned = set(self.live)
+        if self.cluster:
+            self.owned = {n for n in self.owned if self.cluster.owns(n)}
+
+        now = time.time()
+        for svc in added:
+            if svc.name in self.owned:
+                self.push(svc, now + random.uniform(0, self.watcher.poll))
+        for svc in changed:
+            if svc.name in self.owned:
+                due = (svc.checked or now) + svc.next_interval()
+                self.push(svc, max(due, now))
+
+    def housekeeping(self):
+        # leader only, keeps the homepage warm like /_cron does
+        if not self.cluster.lead():
+            return
+        _, updated = self.store.load_meta()
+        pagecache.put('index', index_etag(updated), render_index())
+
+    def collect(self):
+        # back on the heap with whatever the workers have finished
+        while True:
+            try:
+                batch, done = self.finished.get_nowait()
+            except queue.Empty:
+                return
+            self.inflight -= 1
+            for svc in batch:
+                self.checking.discard(svc.name)
+                self.push(svc, done + svc.next_interval())
+
+    def check(self, batch):
+        """
+        Worker body, one batch.  Only traced when no other batch is
+        being, a second Trace would take over the first's spans.
+        Checks from an untraced batch still show up in the traced
+        one's breakdown if they overlap.
+        """
+
+        try:
+            with app.app_context():
+                if self.tracing.acquire(blocking=False):
+                    try:
+                        self.check_traced(batch)
+                    finally:
+                        self.tracing.release()
+                else:
+                    self.sweeper.run(batch)
+                    self.store.save(batch)
+        except Exception as e:
+            app.logger.error(f'scheduler batch error: {e}')
+        finally:
+            self.finished.put((batch, time.time()))
+
+    def check_traced(self, batch):
+        cfg = app.config
+        with tracing.Trace('scheduler', cfg['PROFILE'],
+                           cfg['PROFILE_INTERVAL']) as t:
+            with tracing.span('sweep'):
+                self.sweeper.run(batch)
+            with tracing.span('save'):
+                self.store.save(batch)
+        if cfg['TRACE'] or cfg['PROFILE']:
+            tracing.save(app.redis, self.store.namespace, t,
+                         cfg['TRACE_KEEP'])
+
+    def run_once(self):
+        self.collect()
+        if self.watcher:
+            self.reload_config()
+        now = time.time()
+        if self.cluster and now - self.last_beat >= self.beat:
+            self.rebalance()
+            self.housekeeping()
+
+        # all workers busy, whatever is due goes out next tick
+        if self.inflight >= self.batches:
+            return 0
+        batch = self.due(now)
+        if not batch:
+            return 0
+        self.inflight += 1
+        self.checking.update(svc.name for svc in batch)
+        self.pool.submit(self.check, batch)
+        return len(batch)
+
+    def run(self):
+        while True:
+            n = self.run_once()
+            if n:
+                app.logger.debug(f'scheduler sent {n} services out')
+            if self.heap and self.inflight < self.batches:
+                wait = self.heap[0][0] - time.time()
+                time.sleep(min(max(wait, 0), self.tick))
+            else:
+                time.sleep(self.tick)
+
+
+def main():
+    app.logger.info(f'scheduler v{ __version__ } starting')
+    metrics.reset()
+    with app.app_context():
+        # one load at startup, after that the services live here
+        p = Pinger.load()
+        scheduler = Scheduler(p)
+        try:
+            scheduler.run()
+        finally:
+            scheduler.pool.shutdown(wait=False, cancel_futures=True)
+            if scheduler.cluster:
+                scheduler.cluster.leave()
+
+
+if __name__ == '__main__':
+    main()
@@ -8,18 +8,82 @@
 # --------------------------------------------------------------------------
 
 import time
+import random
 import socket
+import threading
 import subprocess
-import requests
+import urllib.parse
 import ntplib
 from flask import current_app as app
 
 import notification
 import models
+import history
+import events
+import vantage
+import httppool
+import metrics
+import tracing
 
-# from icmplib import ping, multiping, traceroute, resolve, Host, Hop
+__version__ = '1.8'
 
-__version__ = '1.2'
+# which sweep the current thread is checking for, see sweep.py
+_sweep = threading.local()
+
+
+class Generation(object):
+    """
+    One Sweeper.run().  A service only takes a result from the
+    sweep it was last handed to, and only until that sweep closes,
+    so a check that outlived the deadline can't write over (or
+    notify about) a service that is being saved.  Claiming and
+    closing share one lock, and close() waits for settles that
+    got in first, nothing is half written when the caller saves.
+    """
+
+    def __init__(self):
+        self.open = True
+        self.busy = 0
+        self.cond = threading.Condition()
+
+    def claim(self, svc):
+        with self.cond:
+            if not self.open or svc.generation is not self:
+                return False
+            svc.generation = None
+            self.busy += 1
+            return True
+
+    def release(self):
+        with self.cond:
+            self.busy -= 1
+            self.cond.notify_all()
+
+    def close(self, services):
+        """
+        No more results.  Returns the names of the services that
+        never got one.
+        """
+
+        with self.cond:
+            self.open = False
+            skipped = []
+            for svc in services:
+                if svc.generation is self:
+                    svc.generation = None
+                    skipped.append(svc.name)
+            while self.busy:
+                self.cond.wait()
+        return skipped
+
+
+def checking_for(generation):
+    # tag the calling thread's checks with a Generation, or None
+    _sweep.generation = generation
+
+
+def sweep_generation():
+    return getattr(_sweep, 'generation', None)
 
 
 #################################
@@ -29,8 +93,10 @@ __version__ = '1.2'
 #################################
 
 
-class Incident:
-    __version__ = '2.0'
+class Incident(object):
+    __version__ = '2.1'
+    __slots__ = ('start', 'stop', 'response', 'name', 'pretty_name',
+                 'n', 'msg')
 
     def __init__(self, freeze):
         """
@@ -52,9 +118,27 @@ class Incident:
         self.name = freeze['name']
         self.pretty_name = freeze['pretty_name']
         self.n = 1
+        self.stop = None
+        self.msg = None
 
         app.logger.debug(f'Just went down: {self.name}')
 
+    @classmethod
+    def restore(cls, name, pretty_name, start, n, response):
+        """
+        Rebuild an open incident from the state store without
+        logging it as a fresh 'just went down'.
+        """
+
+        incident = cls.__new__(cls)
+        incident.start = start
+        incident.response = response
+        incident.name = name
+        incident.pretty_name = pretty_name
+        incident.n = n
+        incident.stop = None
+        incident.msg = None
+        return incident
 
     def failed_ping(self):
         """
@@ -102,19 +186,23 @@ class Incident:
             stop=self.stop,
             response=self.response,
             n=self.n,
-            name=self.name
+            name=self.name,
+            day=history.day_of(self.stop)
         )
-        ds.save()
+        with metrics.timed(metrics.PERSIST_SECONDS), \
+                tracing.span(self.name, 'dynamodb'):
+            ds.save()
+        history.invalidate()
 
         app.logger.debug(f'dynamodb insert of {ds.__id__}.')
         return
 
     def send_down_msg(self):
-        # now send msg
+        # now send msg - via the notifier queue, see notifier.py
         body = f'{self.pretty_name} just went down. {self.response}'
         msg = notification.Notification(self.pretty_name, body)
         try:
-            msg.send()
+            msg.queue('down')
         except Exception as e:
             app.logger.error(e)
 
@@ -122,7 +210,7 @@ class Incident:
         # send backup notifications
         msg = notification.Notification(self.name, self.msg)
         try:
-            msg.send()
+            msg.queue('up')
         except Exception as e:
             app.logger.error(e)
 
@@ -141,7 +229,11 @@ class Service(object):
     Implements parts of the check() method.
     """
 
-    def __init__(self, name):
+    __slots__ = ('name', 'n', 'last_n', 'alive', 'response', 'timeout',
+                 'interval', 'jitter', 'streak', 'checked', 'dirty',
+                 'incident', 'start_ms', 'elapsed_ms', 'generation')
+
+    def __init__(self, name, interval=None, jitter=None):
         # constructor - called by child class
         self.name = name
 
@@ -155,6 +247,22 @@ class Service(object):
         # all svcs can use the default timeout from config
         self.timeout = app.config['TIMEOUT']
 
+        # only used by scheduler.py, cron checks everything every run
+        self.interval = interval or app.config['CHECK_INTERVAL']
+        if jitter is None:
+            jitter = app.config['CHECK_JITTER']
+        self.jitter = jitter
+        # good checks in a row, stable services back off
+        self.streak = 0
+
+        # when we last checked, and whether the state store is behind
+        self.checked = None
+        self.dirty = False
+        # how long the last probe took, see timeseries.py
+        self.elapsed_ms = None
+        # the sweep waiting on this service's result, see checking_for()
+        self.generation = None
+
         """
         use this attribute to save incidents after 'just down'.
         that way we can easily recall the incidents when the
@@ -168,7 +276,7 @@ class Service(object):
 
         if self.incident:
             return False
-        return True
+        return self.alive
 
     @property
     def pretty_name(self):
@@ -188,6 +296,103 @@ class Service(object):
         }
         return p
 
+    @property
+    def state(self):
+        # everything state.StateStore keeps for us between sweeps
+        incident = self.incident
+        s = {
+          'alive': self.is_alive,
+          'n': self.n,
+          'last_n': self.last_n,
+          'response': self.response,
+          'timestamp': self.checked,
+          'streak': self.streak,
+          'incident_start': incident.start if incident else None,
+          'incident_n': incident.n if incident else None,
+          'incident_response': incident.response if incident else None,
+        }
+        return s
+
+    def restore(self, state):
+        """
+        Apply a (possibly partial) dict from the state store.  Only
+        a full state brings back the live incident, readers that
+        just want alive/dead can skip the incident fields.
+        """
+
+        self.alive = state.get('alive', self.alive)
+        self.n = state.get('n', self.n)
+        self.last_n = state.get('last_n', self.last_n)
+        self.response = state.get('response', self.response)
+        self.checked = state.get('timestamp', self.checked)
+        self.streak = state.get('streak', self.streak)
+
+        if 'incident_start' in state:
+            self.incident = Incident.restore(
+                self.name,
+                self.pretty_name,
+                state['incident_start'],
+                state.get('incident_n', 1),
+                state.get('incident_response', self.response)
+            )
+
+    @property
+    def probe(self):
+        # spec for an agent's /_probe, None if agents can't check us
+        return None
+
+    @property
+    def unconfirmed(self):
+        # failed once, the second strike decides if it's an outage
+        return self.incident is not None and self.incident.n < 2
+
+    @property
+    def adaptive_interval(self):
+        """
+        The interval before jitter.  A service that just failed is
+        re-checked after CHECK_RECHECK seconds to confirm (or clear)
+        the outage.  One that has been up for CHECK_STABLE_AFTER
+        checks in a row doubles its interval, and again every
+        CHECK_STABLE_AFTER after that, up to CHECK_MAX_INTERVAL.
+        """
+
+        cfg = app.config
+        if self.unconfirmed:
+            return min(cfg['CHECK_RECHECK'], self.interval)
+        if self.incident is not None:
+            return self.interval
+        doublings = self.streak // cfg['CHECK_STABLE_AFTER']
+        if not doublings:
+            return self.interval
+        ceiling = max(cfg['CHECK_MAX_INTERVAL'], self.interval)
+        return min(self.interval * 2 ** min(doublings, 16), ceiling)
+
+    def adopt(self, other):
+        """
+        Take over the live state of the service we replace when its
+        site.yml entry changes, so an open incident carries on.
+        """
+
+        self.alive = other.alive
+        self.n = other.n
+        self.last_n = other.last_n
+        self.response = other.response
+        self.checked = other.checked
+        self.streak = other.streak
+        self.incident = other.incident
+        self.dirty = True
+
+    def next_interval(self):
+        """
+        Seconds until the scheduler should check us again, with
+        +/- jitter (a fraction of the interval) so services that
+        share an interval drift apart instead of bursting.
+        """
+
+        interval = self.adaptive_interval
+        spread = interval * self.jitter
+        return interval + random.uniform(-spread, spread)
+
     def timer_start(self):
         # little helper for timing service checks
         # self.start_ms = self.get_ms
@@ -208,9 +413,11 @@ class Service(object):
         for service.n = 2 to trigger notifications.
         """
 
+        self.alive = False
         if self.incident is None:
             # we probably just went down
             self.incident = Incident(self.freeze)
+            events.publish(self, False)
         else:
             """
             well if we already have an incident obj we must just be on
@@ -225,6 +432,7 @@ class Service(object):
         service.n back to 0.
         """
 
+        self.alive = True
         if self.incident is not None:
             # Wow we were in an incident, we must be 'just up'
             self.incident.retire(self.freeze)
@@ -233,6 +441,7 @@ class Service(object):
             # if self.incident.finished:
             del self.incident
             self.incident = None
+            events.publish(self, True)
 
     def check(self):
         """
@@ -240,21 +449,83 @@ class Service(object):
         check method determines if we are up or down.
         """
 
+        t0 = time.monotonic()
         try:
             app.logger.debug('running check for {}.'.format(self.name))
             # this is where service specific checks begin
-            self.response = self._check()
+            response = self._check()
+        except Exception as e:
+            error = e
+            response = None
+        else:
+            error = None
+        self.elapsed_ms = (time.monotonic() - t0) * 1000
+        if error is not None and vantage.enabled(self):
+            # ask the agents before we believe it
+            (response, error), = vantage.review([(self, error)])
+        return self.settle(response=response, error=error)
+
+    async def acheck(self, engine):
+        """
+        Same as check() but runs the probe on an asyncio loop, see
+        aprobe.py.  Only services with an _acheck() can do this.
+        Returns (response, error) so the caller can settle() the
+        result outside of the loop, incidents may block on smtp
+        and dynamodb.
+        """
+
+        t0 = time.monotonic()
+        try:
+            response = await self._acheck(engine)
         except Exception as e:
+            response, error = None, e
+        else:
+            error = None
+        self.elapsed_ms = (time.monotonic() - t0) * 1000
+        return response, error
+
+    def settle(self, response=None, error=None):
+        """
+        Record the outcome of a check and flip incident state.
+        Shared by check() and the async engine so both paths
+        go through the same set_dead()/set_alive() logic.
+        Returns None without touching anything for a result from a
+        sweep that already gave up on us, see Generation.
+        """
+
+        generation = sweep_generation()
+        if generation is None:
+            return self.record(response, error)
+        if not generation.claim(self):
+            app.logger.info(f'{self.name} checked too late, result dropped')
+            return None
+        try:
+            return self.record(response, error)
+        finally:
+            generation.release()
+
+    def record(self, response=None, error=None):
+        # settle() once it is ours to write
+        self.checked = int(time.time())
+        self.dirty = True
+        tracing.record(self.name, self.elapsed_ms,
+                       service_type=self.service_type)
+        if error is not None:
             app.logger.error(
-                'Error - Service Down - {}@{}'.format(self.name, e))
-            self.response = str(e)
+                'Error - Service Down - {}@{}'.format(self.name, error))
+            self.response = str(error)
+            self.streak = 0
             self.set_dead()
+            metrics.check(self)
             return False
         else:
+            self.response = response
+            self.streak += 1
             app.logger.info(
                 '{} check complete.  Service UP!'.format(self.name))
             app.logger.debug('Up! {}@{}'.format(self.response, self.name))
             self.set_alive()
+            metrics.check(self)
             return True
 
     def to_dict(self):
@@ -271,6 +542,7 @@ class Service(object):
           'n': self.n,
           'last_n': self.last_n,
           'timeout': self.timeout,
+          'interval': self.interval,
           'response': self.response
         }
         return d
@@ -282,13 +554,17 @@ class TCP(Service):
     before the timeout.
     """
 
+    service_type = 'tcp'
+    __slots__ = ('ip', 'port')
+
     def __init__(self, **kwargs):
         # This init runs first, then the base class init is called via super()
         name = kwargs['name']
         ip = kwargs['ip']
         port = kwargs['port']
 
-        super().__init__(name)
+        super().__init__(
+            name, kwargs.get('interval'), kwargs.get('jitter'))
         self.ip = ip
         self.port = port
 
@@ -296,6 +572,10 @@ class TCP(Service):
     def description(self):
         return 'tcp://{}:{}'.format(self.ip, self.port)
 
+    @property
+    def probe(self):
+        return {'type': 'tcp', 'ip': self.ip, 'port': self.port}
+
     def _check(self):
         self.timer_start()
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -305,64 +585,47 @@ class TCP(Service):
         r = self.timer_stop()
         return 'elapsed time {}'.format(r)
 
+    async def _acheck(self, engine):
+        self.timer_start()
+        await engine.tcp_connect(self.ip, self.port, self.timeout)
+        r = self.timer_stop()
+        return 'elapsed time {}'.format(r)
+
     def to_dict(self):
         d = super().to_dict()
-        d['service_type'] = 'tcp'
+        d['service_type'] = self.service_type
         d['ip'] = self.ip
         d['port'] = self.port
         return d
 
 
-# class ICMP2(Service):
-#     """
-#     ICMP Ping - tell if a host is alive
-#     On some Linux systems, you must allow this feature:
-#
-#     $ echo 'net.ipv4.ping_group_range = 0 2147483647' | sudo
-#         tee -a /etc/sysctl.conf
-#     $ sudo sysctl -p
-#     You can check the current value with the following command:
-#
-#     $ sysctl net.ipv4.ping_group_range
-#     net.ipv4.ping_group_range = 0 2147483647
-#     """
-#
-#     def __init__(self, **kwargs):
-#         """ This constructor will run first """
-#         super().__init__(name)
-#         self.ip = ip
-#
-#     @property
-#     def description(self):
-#         return 'icmp://{}'.format(self.ip)
-#
-#     def _check(self):
-#         host = ping(self.ip, timeout=self.timeout, privileged=False)
-#         if not host.is_alive:
-#             raise Exception('ICMP host is not alive')
-#         elapsed_ms = host.avg_rtt
-#         self.info = 'avg rtt {}'.format(elapsed_ms)
-#         return
-
-
 class ICMP(Service):
     """
     ICMP checker.  Python must be run as root to open true ICMP socket
-    so this runs the ping binary via shell.
+    so this runs the ping binary via shell.  The sweeper batches these
+    through icmp.multiping() instead when the kernel lets us.
     """
 
+    service_type = 'icmp'
+    __slots__ = ('ip',)
+
     def __init__(self, **kwargs):
         # This init runs first, then the base class init is called via super()
         name = kwargs['name']
         ip = kwargs['ip']
 
-        super().__init__(name)
+        super().__init__(
+            name, kwargs.get('interval'), kwargs.get('jitter'))
         self.ip = ip
 
     @property
     def description(self):
         return 'icmp://{}'.format(self.ip)
 
+    @property
+    def probe(self):
+        return {'type': 'icmp', 'ip': self.ip}
+
     def _check(self):
         alive, response = self.ping()
         if not alive:
@@ -372,6 +635,17 @@ class ICMP(Service):
                 raise Exception('ICMP host is not alive')
         return str(response)
 
+    def settle_rtt(self, rtt):
+        """
+        Settle a result from icmp.multiping() instead of running
+        our own ping.  rtt is None when the host never answered.
+        """
+
+        self.elapsed_ms = rtt
+        if rtt is None:
+            return self.settle(error=Exception('ICMP host is not alive'))
+        return self.settle(response='rtt = {:.2f} ms'.format(rtt))
+
     def ping(self):
         command = ['ping', '-c', '1', self.ip]
         result = subprocess.run(
@@ -388,7 +662,7 @@ class ICMP(Service):
 
     def to_dict(self):
         d = super().to_dict()
-        d['service_type'] = 'icmp'
+        d['service_type'] = self.service_type
         d['ip'] = self.ip
         return d
 
@@ -397,32 +671,59 @@ class HTTP(Service):
     """
     URL checker.  Uses python requests to attempt to open up the
     specified URL.  Also makes sure the server returns a 200 status.
+    Set method: head in site.yml to skip downloading the body.
     """
 
+    service_type = 'http'
+    __slots__ = ('url', 'method')
+
     def __init__(self, **kwargs):
         # This init runs first, then the base class init is called via super()
         name = kwargs['name']
         url = kwargs['url']
+        default = 'head' if app.config['HTTP_HEAD_ONLY'] else 'get'
+        method = kwargs.get('method', default)
 
-        super().__init__(name)
+        super().__init__(
+            name, kwargs.get('interval'), kwargs.get('jitter'))
         self.url = url
+        self.method = method.upper()
 
     @property
     def description(self):
         return self.url
 
+    @property
+    def probe(self):
+        return {'type': 'http', 'url': self.url, 'method': self.method}
+
     def _check(self):
-        response = requests.get(self.url)
+        session = httppool.get_session()
+        response = session.request(
+            self.method,
+            self.url,
+            timeout=(self.timeout, self.timeout),
+            allow_redirects=True
+        )
         status = response.status_code
         if status != 200:
             raise Exception(
               'Expected status code 200 but received {}'.format(status))
         return 'status-code: {}'.format(status)
 
+    async def _acheck(self, engine):
+        status = await engine.http_status(
+            self.url, self.timeout, self.method)
+        if status != 200:
+            raise Exception(
+              'Expected status code 200 but received {}'.format(status))
+        return 'status-code: {}'.format(status)
+
     def to_dict(self):
         d = super().to_dict()
-        d['service_type'] = 'http'
+        d['service_type'] = self.service_type
         d['url'] = self.url
+        d['method'] = self.method
         return d
 
 
@@ -432,12 +733,16 @@ class NTP(Service):
     server is alive, as well as looking at the clock offset.
     """
 
+    service_type = 'ntp'
+    __slots__ = ('ip',)
+
     def __init__(self, **kwargs):
         # This init runs first, then the base class init is called via super()
         name = kwargs['name']
         ip = kwargs['ip']
 
-        super().__init__(name)
+        super().__init__(
+            name, kwargs.get('interval'), kwargs.get('jitter'))
         self.ip = ip
 
     @property
@@ -451,9 +756,14 @@ class NTP(Service):
         offset = 'offset = {:.2f}'.format(response.offset)
         return offset
 
+    async def _acheck(self, engine):
+        response = await engine.ntp_offset(self.ip, self.timeout)
+        offset = 'offset = {:.2f}'.format(response)
+        return offset
+
     def to_dict(self):
         d = super().to_dict()
-        d['service_type'] = 'ntp'
+        d['service_type'] = self.service_type
         d['ip'] = self.ip
         return d
 
@@ -464,13 +774,18 @@ class DHCP(Service):
     offered.  Agent is intended for future expansion.
     """
 
+    service_type = 'dhcp'
+    __slots__ = ('url', 'mac')
+
     def __init__(self, **kwargs):
         # This init runs first, then the base class init is called via super()
         name = kwargs['name']
         url = kwargs['url']
         mac = kwargs.get('mac')
 
-        super().__init__(name)
+        super().__init__(
+            name, kwargs.get('interval'), kwargs.get('jitter'))
+        self.url = url
         if mac and app.config['MAC_PLACEHOLDER'] in url:
             self.url = url.replace(app.config['MAC_PLACEHOLDER'], mac)
         self.mac = mac
@@ -480,9 +795,26 @@ class DHCP(Service):
         mac = getattr(self, 'mac', 'No MAC specified')
         return mac
 
+    @property
+    def agent(self):
+        # base url of the agent, for batching with its other services,
+        # keeping any path prefix it's mounted under
+        parts = urllib.parse.urlsplit(self.url)
+        prefix = parts.path.rpartition('/_dhcp/')[0].rstrip('/')
+        return f'{parts.scheme}://{parts.netloc}{prefix}'
+
+    @property
+    def batch_item(self):
+        return {'id': self.name, 'type': 'dhcp', 'mac': self.mac}
+
     def _check(self):
         try:
-            r = requests.get(self.url)
+            # agent needs a while to wait for an offer
+            session = httppool.get_session()
+            r = session.get(
+                self.url,
+                timeout=(self.timeout, app.config['AGENT_TIMEOUT'])
+            )
             alive = r.json().get('alive')
         except Exception as e:
             app.logger.error(f'DHCP check error: {str(e)}')
@@ -498,7 +830,7 @@ class DHCP(Service):
 
     def to_dict(self):
         d = super().to_dict()
-        d['service_type'] = 'dhcp'
+        d['service_type'] = self.service_type
         d['url'] = self.url
         d['mac'] = self.mac or 'None'
         return d
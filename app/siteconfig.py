@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Hot-reload of site.yml.  Every service definition is fingerprinted,
+so when the file changes only services that were added, removed or
+edited are touched - the rest keep their live state and incidents.
+
+Only what is read through app.config['YAML'] at run time follows the
+file (services, subscribers, smtp/twilio settings).  The url (redis
+namespace) and the tuning knobs copied into app_config.Config still
+need a restart.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from flask import current_app as app
+
+import app_config
+
+__version__ = '1.0'
+
+
+def fingerprint(definition):
+    # stable hash of one service's site.yml entry
+    blob = json.dumps(definition, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+
+def fingerprints(yaml):
+    return {svc['name']: fingerprint(svc) for svc in yaml.services}
+
+
+def version(yaml=None):
+    # one hash for the whole service list, for etags and the like
+    yaml = yaml or app.config['YAML']
+    blob = json.dumps(fingerprints(yaml), sort_keys=True)
+    return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+
+def diff(old, new):
+    """
+    @params - old, new - {name: fingerprint}
+
+    @return - tuple() - (added, removed, changed) lists of names
+    """
+
+    added = [n for n in new if n not in old]
+    removed = [n for n in old if n not in new]
+    changed = [n for n in new if n in old and old[n] != new[n]]
+    return added, removed, changed
+
+
+class Watcher:
+    """
+    Notices site.yml changing (mtime and size) without re-reading
+    it every time, and no more often than every `poll` seconds.
+    """
+
+    def __init__(self, path=app_config.site_cfg, poll=5):
+        self.path = path
+        self.poll = poll
+        self.checked = time.monotonic()
+        self.stamp = self.stat()
+        self.lock = threading.Lock()
+
+    def stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def changed(self):
+        """
+        Returns the freshly parsed yaml if the file changed since
+        we last looked, None otherwise (or if it doesn't parse, a
+        half saved file shouldn't take the site down).
+        """
+
+        now = time.monotonic()
+        if now - self.checked < self.poll:
+            return None
+        with self.lock:
+            self.checked = now
+            stamp = self.stat()
+            if stamp is None or stamp == self.stamp:
+                return None
+            try:
+                yaml = app_config.read_site(self.path)
+                yaml.services
+            except Exception as e:
+                app.logger.error(f'site.yml reload failed, keeping old: {e}')
+                return None
+            self.stamp = stamp
+            return yaml
+
+
+def apply(yaml, store=None):
+    """
+    Make yaml the live config.  Services that disappeared have their
+    state hash and latency series dropped.  Returns the diff against
+    the previous config as (added, removed, changed).
+    """
+
+    old = fingerprints(app.config['YAML'])
+    new = fingerprints(yaml)
+    added, removed, changed = diff(old, new)
+    if yaml.get('url') != app.config['YAML'].get('url'):
+        app.logger.error('site.yml url changed, that needs a restart')
+        yaml['url'] = app.config['YAML'].url
+
+    app.config['YAML'] = yaml
+    app.config['SITE_VERSION'] = version(yaml)
+    if removed and store is not None:
+        store.drop(removed)
+    app.logger.info(
+        f'site.yml reloaded: {len(added)} added, {len(removed)} '
+        f'removed, {len(changed)} changed'
+    )
+    return added, removed, changed
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Uptime / SLA figures from the incident history.
+
+Incidents that ended inside the widest window are queried a day at
+a time off models.DayIndex into flat numpy arrays (service index,
+start, stop), merged per service so overlapping incidents don't
+count twice, and then every window is clipped and summed in one
+vectorized pass.  Groups (the optional 'group' key on a service in
+site.yml) count as down whenever any member is down.
+"""
+
+import json
+import time
+from datetime import datetime
+from datetime import timedelta
+
+import numpy as np
+from flask import current_app as app
+
+import models
+import history
+import state
+
+__version__ = '1.1'
+
+WINDOWS = {
+    '24h': 86400,
+    '7d': 7 * 86400,
+    '30d': 30 * 86400,
+    '90d': 90 * 86400,
+}
+
+
+def ended_since(since, now):
+    """
+    Finished incidents that ended at or after since, one DayIndex
+    query per (utc) day instead of scanning the whole table.  One
+    that ended before since can't overlap any window.
+    """
+
+    attrs = [models.Incident.name, models.Incident.start,
+             models.Incident.stop]
+    day = history.day_of(since)
+    while day <= history.day_of(now):
+        yield from models.Incident.by_day.query(
+            day,
+            range_key_condition=models.Incident.stop >= since,
+            attributes_to_get=attrs
+        )
+        day = (datetime.strptime(day, '%Y-%m-%d') +
+               timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def load_intervals(names, ongoing=(), now=None, since=None):
+    """
+    Pull (service index, start, stop) for every finished incident
+    of the services we know about into numpy arrays, back to since
+    (the widest window).  ongoing is a list of (name, start) for
+    incidents still open, they count as down until now.
+    """
+
+    now = now or time.time()
+    since = since or now - max(WINDOWS.values())
+    index = {name: i for i, name in enumerate(names)}
+    svc, start, stop = [], [], []
+    for name, began in ongoing:
+        svc.append(index[name])
+        start.append(began)
+        stop.append(now)
+    for row in ended_since(since, now):
+        i = index.get(row.name)
+        if i is None or row.start is None or row.stop is None:
+            continue
+        svc.append(i)
+        start.append(row.start)
+        stop.append(row.stop)
+    return (np.array(svc, dtype=np.int32),
+            np.array(start, dtype=np.float64),
+            np.array(stop, dtype=np.float64))
+
+
+def merge(keys, start, stop):
+    """
+    Merge overlapping intervals within each key.  Sort by (key,
+    start), carry a running max of stop per key, and start a new
+    interval wherever the gap opens up or the key changes.
+    """
+
+    if len(start) == 0:
+        return keys, start, stop
+
+    order = np.lexsort((start, keys))
+    keys, start, stop = keys[order], start[order], stop[order]
+
+    # running max of stop, reset at each key boundary
+    boundary = np.r_[True, keys[1:] != keys[:-1]]
+    group = np.cumsum(boundary) - 1
+    offset = (group * (stop.max() - stop.min() + 1)).astype(np.float64)
+    run_max = np.maximum.accumulate(stop + offset) - offset
+
+    new = np.r_[True, start[1:] > run_max[:-1]] | boundary
+    ids = np.cumsum(new) - 1
+    out_keys = keys[new]
+    out_start = start[new]
+    out_stop = np.zeros(len(out_start))
+    np.maximum.at(out_stop, ids, run_max)
+    return out_keys, out_start, out_stop
+
+
+def downtime(keys, start, stop, n, window_start, window_stop):
+    # seconds down per key inside [window_start, window_stop)
+    clipped = (np.minimum(stop, window_stop) -
+               np.maximum(start, window_start)).clip(min=0)
+    return np.bincount(keys, weights=clipped, minlength=n)
+
+
+def compute(names, groups, ongoing=(), windows=None, now=None):
+    """
+    @params - names - service names, in display order
+    @params - groups - {group name: [service names]}
+    @params - ongoing - [(name, start)] of incidents still open
+    @params - windows - {label: seconds}, defaults to WINDOWS
+
+    @return - dict() - {'services': {name: {window: pct}},
+    'groups': {...}, 'generated': ts}
+    """
+
+    now = now or time.time()
+    windows = windows or WINDOWS
+    keys, start, stop = load_intervals(
+        names, ongoing, now, since=now - max(windows.values()))
+    m_keys, m_start, m_stop = merge(keys, start, stop)
+
+    # groups: remap each member's incidents onto the group, merge again
+    group_names = list(groups)
+    g_keys, g_start, g_stop = [], [], []
+    for gi, g in enumerate(group_names):
+        members = np.isin(keys, [names.index(n) for n in groups[g]])
+        g_keys.append(np.full(members.sum(), gi, dtype=np.int32))
+        g_start.append(start[members])
+        g_stop.append(stop[members])
+    if group_names:
+        gm = merge(np.concatenate(g_keys), np.concatenate(g_start),
+                   np.concatenate(g_stop))
+    else:
+        gm = (keys[:0], start[:0], stop[:0])
+
+    out = {'services': {n: {} for n in names},
+           'groups': {g: {} for g in group_names},
+           'generated': int(now)}
+    for label, width in windows.items():
+        down = downtime(m_keys, m_start, m_stop, len(names), now - width, now)
+        pct = np.round(100.0 * (1 - down / width), 3)
+        for name, p in zip(names, pct):
+            out['services'][name][label] = float(p)
+
+        down = downtime(*gm, len(group_names), now - width, now)
+        pct = np.round(100.0 * (1 - down / width), 3)
+        for g, p in zip(group_names, pct):
+            out['groups'][g][label] = float(p)
+    return out
+
+
+def cache_key():
+    return f'{app.config["YAML"].url}:sla'
+
+
+def uptime():
+    """
+    Cached compute() for the configured services.  The cache is
+    tagged with history.version(), which Incident.persist() bumps,
+    and the site.yml version.  Otherwise it expires after
+    SLA_CACHE_TTL so the windows keep sliding forward and open
+    incidents keep counting.
+    """
+
+    version = f'{history.version()}:{app.config["SITE_VERSION"]}'
+    cached = app.redis.get(cache_key())
+    if cached:
+        cached = json.loads(cached)
+        if cached.get('version') == version:
+            return cached
+
+    names = []
+    groups = {}
+    for svc in app.config['YAML'].services:
+        names.append(svc['name'])
+        if svc.get('group'):
+            groups.setdefault(svc['group'], []).append(svc['name'])
+
+    store = state.StateStore(app.redis, app.config['YAML'].url)
+    states = store.load_names(names, ['incident_start'])
+    ongoing = [(n, s['incident_start'])
+               for n, s in zip(names, states) if 'incident_start' in s]
+
+    result = compute(names, groups, ongoing)
+    result['version'] = version
+    app.redis.set(
+        cache_key(),
+        json.dumps(result),
+        ex=app.config['SLA_CACHE_TTL']
+    )
+    return result
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+import time
+
+import timeseries
+import metrics
+
+__version__ = '1.3'
+
+# field name -> decoder, everything goes into redis as a string
+FIELDS = {
+    'alive': lambda v: v == b'1',
+    'n': int,
+    'last_n': int,
+    'response': lambda v: v.decode('utf-8', 'replace'),
+    'timestamp': int,
+    'streak': int,
+    'incident_start': float,
+    'incident_n': int,
+    'incident_response': lambda v: v.decode('utf-8', 'replace'),
+}
+
+
+def encode(value):
+    if value is True:
+        return '1'
+    if value is False:
+        return '0'
+    return str(value)
+
+
+#################################
+#                               #
+#         StateStore            #
+#                               #
+#################################
+
+
+class StateStore:
+    """
+    Keeps each service's live state in its own small redis hash
+    instead of pickling the whole Pinger into one key.
+
+    <namespace>:pinger          created, updated
+    <namespace>:svc:<name>      alive, n, last_n, response, ...
+    """
+
+    def __init__(self, redis, namespace):
+        self.redis = redis
+        self.namespace = namespace
+        self.series = timeseries.TimeSeries(redis, namespace)
+
+    def key(self, name):
+        return f'{self.namespace}:svc:{name}'
+
+    @property
+    def meta_key(self):
+        return f'{self.namespace}:pinger'
+
+    def save(self, services, force=False):
+        """
+        Write the state of every service that was checked since
+        the last save (or all of them with force=True) plus the
+        pinger's updated time, in one round trip.  Each checked
+        service also gets a latency sample in timeseries.py.
+        Returns the number of services written.
+        """
+
+        ts = time.perf_counter()
+        pipe = self.redis.pipeline(transaction=False)
+        written = 0
+        size = 0
+        samples = []
+        for svc in services:
+            if not (svc.dirty or force):
+                continue
+            if svc.dirty and svc.checked:
+                ms = None
+                if svc.is_alive:
+                    ms = svc.elapsed_ms or 0.0
+                samples.append((svc.name, svc.checked, ms))
+            state = svc.state
+            key = self.key(svc.name)
+            mapping = {}
+            gone = []
+            for field, value in state.items():
+                if value is None:
+                    gone.append(field)
+                else:
+                    mapping[field] = encode(value)
+                    size += len(field) + len(mapping[field])
+            pipe.hset(key, mapping=mapping)
+            if gone:
+                pipe.hdel(key, *gone)
+            svc.dirty = False
+            written += 1
+
+        now = int(time.time())
+        pipe.hsetnx(self.meta_key, 'created', now)
+        pipe.hset(self.meta_key, 'updated', now)
+        pipe.execute()
+
+        # every check is also a latency sample
+        self.series.record(samples)
+        metrics.observe(metrics.STATE_SECONDS, time.perf_counter() - ts,
+                        op='save')
+        metrics.observe(metrics.STATE_BYTES, size)
+        return written
+
+    def drop(self, names):
+        # forget services that left site.yml, state and latency history
+        self.redis.delete(*[self.key(name) for name in names])
+        for name in names:
+            self.series.drop(name)
+
+    def load(self, services, fields=None):
+        """
+        Fetch state for the given services, optionally only a
+        few fields.  Returns a list of dicts in the same order,
+        services with nothing stored yet get an empty dict.
+        """
+
+        return self.load_names([svc.name for svc in services], fields)
+
+    def load_names(self, names, fields=None):
+        # same as load() for when all we have is the service names
+        fields = list(fields or FIELDS)
+        pipe = self.redis.pipeline(transaction=False)
+        for name in names:
+            pipe.hmget(self.key(name), fields)
+
+        states = []
+        with metrics.timed(metrics.STATE_SECONDS, op='load'):
+            results = pipe.execute()
+        for values in results:
+            state = {}
+            for field, value in zip(fields, values):
+                if value is not None:
+                    state[field] = FIELDS[field](value)
+            states.append(state)
+        return states
+
+    def load_meta(self):
+        """
+        Returns (created, updated) unix timestamps or Nones on
+        a cold cache.
+        """
+
+        created, updated = self.redis.hmget(
+            self.meta_key, ['created', 'updated'])
+        if created is not None:
+            created = int(created)
+        if updated is not None:
+            updated = int(updated)
+        return created, updated
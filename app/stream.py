@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Server-Sent Events for the status page.  A tiny aiohttp server
+instead of a flask route, so hundreds of idle browsers cost a few
+kb each instead of a gunicorn sync worker each.  Route /stream to
+it (see examples/traefik.yml).
+
+    $ python3 stream.py
+"""
+
+import time
+import asyncio
+import logging
+import threading
+
+from aiohttp import web
+from redis import Redis
+
+import events
+from app_config import Config
+
+__version__ = '1.1'
+
+PORT = 8081
+HEARTBEAT = 15
+QUEUE_SIZE = 100
+# redis dropped, wait this long before resubscribing, doubling up to max
+BACKOFF = 1
+BACKOFF_MAX = 30
+
+log = logging.getLogger('stream')
+
+
+class Hub:
+    """
+    One redis subscription for the whole process, fanned out to
+    a queue per connected browser.  The subscriber is a plain
+    thread (redis-py is blocking) that hands messages to the loop.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.clients = set()
+        self.seq = 0
+        # the subscriber thread is up and subscribed
+        self.listening = False
+
+    def listen(self, redis, channel):
+        """
+        Runs forever, resubscribing with backoff whenever redis goes
+        away.  Browsers miss what was published in between and catch
+        up on their next reload.
+        """
+
+        wait = BACKOFF
+        while True:
+            try:
+                pubsub = redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(channel)
+                self.listening = True
+                wait = BACKOFF
+                for message in pubsub.listen():
+                    data = message['data'].decode('utf-8')
+                    self.loop.call_soon_threadsafe(self.broadcast, data)
+            except Exception as e:
+                log.error(f'redis subscription lost: {e}, retry in {wait}s')
+            self.listening = False
+            time.sleep(wait)
+            wait = min(wait * 2, BACKOFF_MAX)
+
+    def broadcast(self, data):
+        self.seq += 1
+        for q in list(self.clients):
+            try:
+                q.put_nowait((self.seq, data))
+            except asyncio.QueueFull:
+                # too slow to keep up, let it reconnect and reload
+                self.drop(q)
+            except Exception as e:
+                log.error(f'dropping stream client: {e}')
+                self.drop(q)
+
+    def drop(self, q):
+        # make room for the close sentinel, the client is going anyway
+        self.clients.discard(q)
+        try:
+            q.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        q.put_nowait(None)
+
+
+async def stream(request):
+    hub = request.app['hub']
+    resp = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    await resp.prepare(request)
+    await resp.write(b'retry: 5000\n\n')
+
+    q = asyncio.Queue(maxsize=QUEUE_SIZE)
+    hub.clients.add(q)
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(q.get(), HEARTBEAT)
+            except asyncio.TimeoutError:
+                # comment line keeps proxies from timing us out
+                await resp.write(b': ping\n\n')
+                continue
+            if item is None:
+                break
+            seq, data = item
+            await resp.write(f'id: {seq}\ndata: {data}\n\n'.encode())
+    except (ConnectionResetError, asyncio.CancelledError):
+        pass
+    finally:
+        hub.clients.discard(q)
+    return resp
+
+
+async def health(request):
+    # unhealthy while the redis subscription is down, nothing to relay
+    hub = request.app['hub']
+    body = {'success': hub.listening, 'clients': len(hub.clients)}
+    return web.json_response(body, status=200 if hub.listening else 503)
+
+
+async def start_hub(app):
+    hub = Hub(asyncio.get_running_loop())
+    app['hub'] = hub
+    redis = Redis.from_url(Config.REDIS_URL)
+    t = threading.Thread(
+        target=hub.listen,
+        args=(redis, events.channel(Config.YAML.url)),
+        name='stream-sub',
+        daemon=True
+    )
+    t.start()
+
+
+def make_app():
+    app = web.Application()
+    app.on_startup.append(start_hub)
+    app.router.add_get('/stream', stream)
+    app.router.add_get('/_health/stream', health)
+    return app
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format=Config.LOG_FORMAT,
+        datefmt=Config.LOG_FORMAT_DATE,
+        level=logging.INFO
+    )
+    log.info(f'stream v{ __version__ } on :{PORT}')
+    web.run_app(make_app(), port=PORT, print=None)
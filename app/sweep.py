@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from flask import current_app as app
+
+from services import Generation
+from services import checking_for
+from services import sweep_generation
+
+import icmp
+import vantage
+import metrics
+
+__version__ = '1.7'
+
+# agents that answered /_batch with a 404, pre 0.0.5 - checked one
+# service at a time from then on
+LEGACY_AGENTS = set()
+
+
+#################################
+#                               #
+#         Sweeper               #
+#                               #
+#################################
+
+
+class Sweeper:
+    """
+    Runs every service check concurrently instead of one after
+    another.  A thread pool does the work, each service_type gets
+    its own semaphore so we don't hammer e.g. the dhcp agent, and
+    the whole sweep gives up after a deadline so we never overrun
+    the next cron run.
+    """
+
+    def __init__(self, workers=None, limits=None, deadline=None):
+        cfg = app.config
+        self.workers = workers or cfg['SWEEP_WORKERS']
+        self.limits = limits or cfg['SWEEP_TYPE_LIMITS']
+        self.deadline = deadline or cfg['SWEEP_DEADLINE']
+        self.use_async = cfg['SWEEP_ASYNC']
+        self.use_multiping = cfg['SWEEP_MULTIPING'] and icmp.available()
+        self.async_concurrency = cfg['SWEEP_ASYNC_CONCURRENCY']
+        self.dhcp_batch = cfg['SWEEP_DHCP_BATCH']
+
+        # we need the real app obj, the proxy is useless in threads
+        self.app = app._get_current_object()
+        self.semaphores = {}
+        for service_type, n in self.limits.items():
+            self.semaphores[service_type] = threading.BoundedSemaphore(n)
+
+    def _tagged(self, generation, fn, *args):
+        # worker wrapper, settle() needs to know which sweep this is for
+        checking_for(generation)
+        try:
+            return fn(*args)
+        finally:
+            checking_for(None)
+
+    def _settle(self, svc, settle, *args, **kwargs):
+        """
+        settle() one result of a batch.  A failure here (redis, the
+        notification queue, dynamodb) is logged against the service
+        and the batch carries on, one bad service mustn't leave the
+        rest of its batch unsettled.
+        """
+
+        try:
+            settle(*args, **kwargs)
+        except Exception as e:
+            app.logger.error(f'{svc.name} failed to settle: {e}')
+
+    def _run_one(self, svc):
+        """
+        Worker body.  Threads don't inherit the flask app context
+        so push one before calling check(), the services (and
+        their incidents) log and read config through current_app.
+        """
+
+        sem = self.semaphores.get(svc.service_type)
+        with self.app.app_context():
+            if sem is None:
+                return svc.check()
+            with sem:
+                return svc.check()
+
+    def _run_async(self, services):
+        """
+        Probe every asyncio capable service on a single event loop,
+        then settle the results back in this thread.  Returns the
+        number of services that missed the deadline.
+        """
+
+        # aiohttp is a tenth of a second of import, only sweepers pay it
+        import aprobe
+
+        with self.app.app_context():
+            results = aprobe.run(
+                services,
+                self.async_concurrency,
+                self.deadline,
+                keepalive=app.config['HTTP_KEEPALIVE']
+            )
+            failed = [(svc, e) for svc, _, e in results if e is not None]
+            reviewed = iter(vantage.review(failed))
+            for svc, response, error in results:
+                if error is not None:
+                    response, error = next(reviewed)
+                self._settle(svc, svc.settle,
+                             response=response, error=error)
+        return len(services) - len(results)
+
+    def _run_icmp(self, services):
+        """
+        Ping every icmp service in one go from a single socket.
+        If the socket goes away on us mid-sweep fall back to
+        the ping binary one service at a time.
+        """
+
+        with self.app.app_context():
+            timeout = max(s.timeout for s in services)
+            try:
+                rtts = icmp.multiping([s.ip for s in services], timeout)
+            except OSError as e:
+                app.logger.error(f'multiping failed, using ping: {e}')
+                for svc in services:
+                    self._settle(svc, svc.check)
+                return
+            lost = Exception('ICMP host is not alive')
+            failed = [(s, lost) for s, rtt in zip(services, rtts) if rtt is None]
+            reviewed = iter(vantage.review(failed))
+            for svc, rtt in zip(services, rtts):
+                if rtt is None:
+                    response, error = next(reviewed)
+                    if error is None:
+                        svc.elapsed_ms = None
+                        self._settle(svc, svc.settle, response=response)
+                        continue
+                self._settle(svc, svc.settle_rtt, rtt)
+
+    def _run_dhcp(self, agent, services):
+        """
+        Every dhcp service behind one agent in a single request, the
+        agent streams results back as the offers come in.  Anything
+        the agent never answers for counts as down.
+        """
+
+        with self.app.app_context():
+            by_name = {svc.name: svc for svc in services}
+            items = [svc.batch_item for svc in services]
+            t0 = time.monotonic()
+            try:
+                for result in vantage.stream(
+                        agent, items, app.config['DHCP_OFFER_TIMEOUT']):
+                    svc = by_name.pop(result.get('id'), None)
+                    if svc is None:
+                        continue
+                    svc.elapsed_ms = (time.monotonic() - t0) * 1000
+                    if result.get('alive'):
+                        self._settle(svc, svc.settle,
+                                     response=result.get('response'))
+                    else:
+                        self._settle(svc, svc.settle, error=Exception(
+                            'Remote machine determined that DHCP has '
+                            'failed the check: {}'.format(
+                                result.get('response', result.get('e')))))
+                error = Exception('agent sent no result')
+            except Exception as e:
+                response = getattr(e, 'response', None)
+                status = getattr(response, 'status_code', None)
+                if status in (401, 403, 404) and len(by_name) == len(items):
+                    # old agent, or no agent_token - one by one instead
+                    app.logger.error(
+                        f'DHCP batch refused by {agent} ({status}), '
+                        'falling back to /_dhcp/<mac>')
+                    if status == 404:
+                        LEGACY_AGENTS.add(agent)
+                    self._run_each(services)
+                    return
+                app.logger.error(f'DHCP batch error from {agent}: {e}')
+                error = Exception('error in initial agent communications')
+            for svc in by_name.values():
+                self._settle(svc, svc.settle, error=error)
+
+    def _run_each(self, services):
+        # plain per service check()s, for agents that won't take a batch
+        generation = sweep_generation()
+        with ThreadPoolExecutor(
+                max_workers=self.limits.get('dhcp', 2),
+                thread_name_prefix='sweep-dhcp') as pool:
+            list(pool.map(
+                lambda svc: self._tagged(generation, self._run_one, svc),
+                services))
+
+    def run(self, services):
+        """
+        Check all services, returns a tuple of (done, late) counts.
+        Results are written straight into the service objects so the
+        caller just has to save the pinger afterwards.
+        """
+
+        ts = time.monotonic()
+        sync_svcs = []
+        async_svcs = []
+        icmp_svcs = []
+        dhcp_svcs = {}
+        for svc in services:
+            if self.use_async and hasattr(svc, '_acheck'):
+                async_svcs.append(svc)
+            elif self.use_multiping and svc.service_type == 'icmp':
+                icmp_svcs.append(svc)
+            elif self.dhcp_batch and svc.service_type == 'dhcp' \
+                    and svc.mac and svc.agent not in LEGACY_AGENTS:
+                # no mac means it's baked into the url, nothing to batch
+                dhcp_svcs.setdefault(svc.agent, []).append(svc)
+            else:
+                sync_svcs.append(svc)
+
+        generation = Generation()
+        for svc in services:
+            svc.generation = generation
+        pool = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix='sweep'
+        )
+
+        def submit(fn, *args):
+            return pool.submit(self._tagged, generation, fn, *args)
+
+        futures = [submit(self._run_one, svc) for svc in sync_svcs]
+        # futures that cover more than one service -> how many
+        batches = {}
+        async_future = None
+        if async_svcs:
+            async_future = submit(self._run_async, async_svcs)
+            batches[async_future] = len(async_svcs)
+        if icmp_svcs:
+            batches[submit(self._run_icmp, icmp_svcs)] = len(icmp_svcs)
+        for agent, svcs in dhcp_svcs.items():
+            batches[submit(self._run_dhcp, agent, svcs)] = len(svcs)
+        futures.extend(batches)
+        done, late = wait(futures, timeout=self.deadline)
+
+        # anything still queued is dropped, anything already running
+        # is left to finish on its own, but whatever it finds out is
+        # ignored (see services.Generation) - we save without it
+        pool.shutdown(wait=False, cancel_futures=True)
+        skipped = generation.close(services)
+        if skipped:
+            app.logger.info(f'skipped, no result in time: {skipped[:20]}')
+
+        n_late = sum(batches.get(f, 1) for f in late)
+        for f in done:
+            e = f.exception()
+            if e is not None:
+                app.logger.error(f'sweep worker error: {e}')
+            elif f is async_future:
+                n_late += f.result()
+
+        elapsed = time.monotonic() - ts
+        n_done = len(services) - n_late
+        metrics.sweep(elapsed, n_late)
+        app.logger.info(
+            f'sweep of {len(services)} services took {elapsed:.2f}s, '
+            f'{n_late} missed the {self.deadline}s deadline'
+        )
+        return n_done, n_late
+
+    def confirm(self, services, started=None):
+        """
+        Cron only gets one shot every five minutes, so instead of
+        waiting for the next run to deliver the second strike, give
+        the services that just failed for the first time another
+        check after CHECK_RECHECK seconds.  Skipped if that would
+        run past the sweep deadline, and the re-check only gets what
+        is left of it.  Returns how many were re-checked.
+        """
+
+        suspects = [svc for svc in services if svc.unconfirmed]
+        if not suspects:
+            return 0
+        pause = app.config['CHECK_RECHECK']
+        if started is not None:
+            left = self.deadline - (time.monotonic() - started)
+            if pause >= left:
+                app.logger.info('no time left to confirm failures')
+                return 0
+        time.sleep(pause)
+        app.logger.info(f're-checking {len(suspects)} failed services')
+        sweeper = self
+        if started is not None:
+            # what's left of ours, not a whole new deadline
+            sweeper = Sweeper(self.workers, self.limits, left - pause)
+        sweeper.run(suspects)
+        return len(suspects)
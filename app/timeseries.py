@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Latency and up/down history per service, kept in redis as packed
+binary ring buffers (no json).
+
+<ns>:ts:<name>:raw          ring of SAMPLE records, every check
+<ns>:ts:<name>:1m|1h|1d     rings of ROLLUP records
+<ns>:ts:<name>:open:<tier>  float32 samples of the bucket in progress
+<ns>:ts:<name>:meta         tier -> start of the bucket in progress
+
+A down check is stored as NaN.  When a sample lands in a new bucket
+the previous one is closed: its open samples are reduced to
+min/avg/p95/max and appended to that tier's ring.
+"""
+
+import math
+import struct
+
+__version__ = '1.0'
+
+# (ts, ms)
+SAMPLE = struct.Struct('<If')
+# (bucket start, min, avg, p95, max, count, up)
+ROLLUP = struct.Struct('<IffffHH')
+FLOAT = struct.Struct('<f')
+
+# tier name, bucket width (s), ring size
+TIERS = (
+    ('1m', 60, 1440),
+    ('1h', 3600, 720),
+    ('1d', 86400, 400),
+)
+RAW_SIZE = 4096
+
+# append one record to a ring: KEYS = ring, counter  ARGV = record, size
+RING_APPEND = """
+local i = redis.call('INCR', KEYS[2]) - 1
+local size = tonumber(ARGV[2])
+redis.call('SETRANGE', KEYS[1], (i % size) * string.len(ARGV[1]), ARGV[1])
+return i
+"""
+
+
+def rollup(start, values):
+    """
+    Reduce one bucket of samples to a ROLLUP record.  Stats only
+    cover the up samples, count/up say how many of each we saw.
+    """
+
+    up = sorted(v for v in values if not math.isnan(v))
+    if up:
+        p95 = up[max(math.ceil(len(up) * 0.95) - 1, 0)]
+        stats = (up[0], sum(up) / len(up), p95, up[-1])
+    else:
+        stats = (math.nan,) * 4
+    count = min(len(values), 0xffff)
+    return ROLLUP.pack(start, *stats, count, min(len(up), 0xffff))
+
+
+class TimeSeries:
+    def __init__(self, redis, namespace):
+        self.redis = redis
+        self.namespace = namespace
+        self.append = redis.register_script(RING_APPEND)
+
+    def key(self, name, suffix):
+        return f'{self.namespace}:ts:{name}:{suffix}'
+
+    def record(self, samples):
+        """
+        Store a batch of (name, ts, ms or None) samples.  None means
+        the check failed.  Costs two round trips for the whole batch,
+        three when some buckets close.
+        """
+
+        if not samples:
+            return
+        samples = [(n, int(ts), math.nan if ms is None else ms)
+                   for n, ts, ms in samples]
+
+        tiers = [t[0] for t in TIERS]
+        pipe = self.redis.pipeline(transaction=False)
+        for name, _, _ in samples:
+            pipe.hmget(self.key(name, 'meta'), tiers)
+        metas = pipe.execute()
+
+        # find the buckets this batch closes
+        closing = []
+        for (name, ts, _), meta in zip(samples, metas):
+            for (tier, width, size), current in zip(TIERS, meta):
+                bucket = ts - ts % width
+                if current is not None and int(current) != bucket:
+                    closing.append((name, tier, size, int(current)))
+
+        closed = []
+        if closing:
+            pipe = self.redis.pipeline(transaction=False)
+            for name, tier, _, _ in closing:
+                pipe.get(self.key(name, f'open:{tier}'))
+            closed = pipe.execute()
+
+        pipe = self.redis.pipeline(transaction=False)
+        for (name, tier, size, start), raw in zip(closing, closed):
+            values = [v for (v,) in FLOAT.iter_unpack(raw or b'')]
+            self.append(
+                keys=[self.key(name, tier), self.key(name, f'{tier}:i')],
+                args=[rollup(start, values), size],
+                client=pipe
+            )
+            pipe.delete(self.key(name, f'open:{tier}'))
+
+        for name, ts, ms in samples:
+            self.append(
+                keys=[self.key(name, 'raw'), self.key(name, 'raw:i')],
+                args=[SAMPLE.pack(ts, ms), RAW_SIZE],
+                client=pipe
+            )
+            buckets = {}
+            for tier, width, _ in TIERS:
+                pipe.append(self.key(name, f'open:{tier}'), FLOAT.pack(ms))
+                buckets[tier] = ts - ts % width
+            pipe.hset(self.key(name, 'meta'), mapping=buckets)
+        pipe.execute()
+
+    def raw(self, name, since=0):
+        # every raw sample still in the ring, oldest first
+        data = self.redis.get(self.key(name, 'raw')) or b''
+        rows = [
+            {'ts': ts, 'ms': None if math.isnan(ms) else ms}
+            for ts, ms in SAMPLE.iter_unpack(data)
+            if ts and ts >= since
+        ]
+        rows.sort(key=lambda r: r['ts'])
+        return rows
+
+    def rollups(self, name, tier, since=0):
+        # closed buckets for one tier, oldest first
+        data = self.redis.get(self.key(name, tier)) or b''
+        rows = []
+        for start, lo, avg, p95, hi, count, up in ROLLUP.iter_unpack(data):
+            if not start or start < since:
+                continue
+            row = {'ts': start, 'count': count, 'up': up}
+            for field, v in (('min', lo), ('avg', avg),
+                             ('p95', p95), ('max', hi)):
+                row[field] = None if math.isnan(v) else round(v, 2)
+            rows.append(row)
+        rows.sort(key=lambda r: r['ts'])
+        return rows
+
+    def drop(self, name):
+        # forget everything about a service, e.g. removed from config
+        keys = [self.key(name, s) for s in ('raw', 'raw:i', 'meta')]
+        for tier, _, _ in TIERS:
+            keys += [self.key(name, tier), self.key(name, f'{tier}:i'),
+                     self.key(name, f'open:{tier}')]
+        self.redis.delete(*keys)
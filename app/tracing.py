@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Where did the sweep go?  Every sweep runs inside a Trace, the phases
+(load, sweep, confirm, save, ...) are spans around it and every
+settled check, dynamodb write and notification adds a span of its
+own.  At the end a small breakdown is kept in redis next to the
+pinger, the last TRACE_KEEP per kind of sweep:
+
+    <namespace>:pinger:trace:cron
+    <namespace>:pinger:trace:scheduler
+
+With profiling on (/_cron?profile=1, profile: true in site.yml or
+PYPING_PROFILE=1) a sampler thread also grabs every thread's stack
+every PROFILE_INTERVAL seconds.  The samples are stored as collapsed
+stacks, one "frame;frame;frame count" per line, which flamegraph.pl,
+speedscope and friends read as is - see /_trace/profile.
+
+Spans go to the one trace running in this process.  Fine for cron
+(a sync gunicorn worker serves one request at a time) and the
+scheduler, outside of a trace span() costs next to nothing.  (Not
+trace.py, that name is taken by the stdlib.)
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+__version__ = '1.0'
+
+# how many of the slowest checks a breakdown keeps
+SLOWEST = 10
+
+_current = None
+
+
+def current():
+    return _current
+
+
+@contextmanager
+def span(name, kind='phase', **tags):
+    """
+    Time the with block into the running trace, if there is one.
+    Phases show up in order in the breakdown, other kinds are
+    summed up (see Trace.breakdown).
+    """
+
+    trace = _current
+    if trace is None:
+        yield
+        return
+    ts = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, kind, ts, (time.perf_counter() - ts) * 1000, tags)
+
+
+def record(name, ms, kind='check', **tags):
+    # a span that was already timed elsewhere, checks have elapsed_ms
+    trace = _current
+    if trace is None or ms is None:
+        return
+    trace.add(name, kind, time.perf_counter() - ms / 1000, ms, tags)
+
+
+class Trace:
+    """
+    One sweep's spans, and its profile when sampling.  Use it as a
+    context manager around the whole sweep.
+    """
+
+    def __init__(self, name, profile=False, interval=0.005):
+        self.name = name
+        self.started = time.time()
+        self.ms = None
+        self.spans = []
+        self.sampler = Sampler(interval) if profile else None
+        self.t0 = None
+
+    def __enter__(self):
+        global _current
+        self.t0 = time.perf_counter()
+        _current = self
+        if self.sampler is not None:
+            self.sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        global _current
+        if self.sampler is not None:
+            self.sampler.stop()
+        _current = None
+        self.ms = (time.perf_counter() - self.t0) * 1000
+        return False
+
+    def add(self, name, kind, start, ms, tags=None):
+        # list.append is atomic, the sweep threads need no lock
+        offset = (start - self.t0) * 1000
+        self.spans.append((name, kind, offset, ms, tags or {}))
+
+    def breakdown(self):
+        """
+        @return - dict() - the phases in order, count/total/max per
+        kind of span and per service_type, the slowest checks and
+        the collapsed profile (or None).
+        """
+
+        phases = []
+        kinds = {}
+        types = {}
+        checks = []
+        for name, kind, offset, ms, tags in self.spans:
+            if kind == 'phase':
+                phases.append({'name': name, 'at': round(offset, 2),
+                               'ms': round(ms, 2)})
+                continue
+            tally(kinds, kind, ms)
+            if kind == 'check':
+                tally(types, tags.get('service_type'), ms)
+                checks.append((ms, name, tags.get('service_type')))
+        checks.sort(reverse=True)
+
+        d = {
+            'name': self.name,
+            'started': int(self.started),
+            'ms': round(self.ms or 0, 2),
+            'phases': phases,
+            'kinds': kinds,
+            'service_types': types,
+            'slowest': [
+                {'name': n, 'service_type': t, 'ms': round(ms, 2)}
+                for ms, n, t in checks[:SLOWEST]
+            ],
+            'samples': 0,
+            'profile': None,
+        }
+        if self.sampler is not None:
+            d['samples'] = self.sampler.samples
+            d['profile'] = self.sampler.collapsed()
+        return d
+
+
+def tally(into, key, ms):
+    t = into.setdefault(key, {'n': 0, 'ms': 0.0, 'max': 0.0})
+    t['n'] += 1
+    t['ms'] = round(t['ms'] + ms, 2)
+    t['max'] = round(max(t['max'], ms), 2)
+
+
+#################################
+#                               #
+#         Sampler               #
+#                               #
+#################################
+
+
+class Sampler:
+    """
+    Poor man's sampling profiler, stdlib only.  A daemon thread
+    walks sys._current_frames() every `interval` seconds and counts
+    each thread's stack, root first.  Threads are named by their
+    pool (sweep_3 -> sweep) so the workers fold into one tower.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.done = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.loop, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def loop(self):
+        me = threading.get_ident()
+        while not self.done.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                thread = re.sub(r'_\d+$', '', names.get(ident, 'thread'))
+                stack = [thread]
+                stack.extend(reversed(frames(frame)))
+                key = ';'.join(stack)
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def collapsed(self):
+        # the folded format: one "a;b;c count" line per distinct stack
+        return '\n'.join(
+            f'{stack} {n}' for stack, n in sorted(self.stacks.items()))
+
+
+def frames(frame):
+    out = []
+    while frame is not None:
+        code = frame.f_code
+        name = os.path.basename(code.co_filename)
+        out.append(f'{code.co_name} ({name}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return out
+
+
+#################################
+#                               #
+#         Storage               #
+#                               #
+#################################
+
+
+def key(namespace, name):
+    return f'{namespace}:pinger:trace:{name}'
+
+
+def save(redis, namespace, trace, keep=20):
+    """
+    Keep the breakdown, newest first, trimmed to `keep`.  Returns
+    the breakdown that was stored.
+    """
+
+    d = trace.breakdown()
+    k = key(namespace, trace.name)
+    pipe = redis.pipeline(transaction=False)
+    pipe.lpush(k, json.dumps(d))
+    pipe.ltrim(k, 0, keep - 1)
+    pipe.execute()
+    return d
+
+
+def recent(redis, namespace, name, n=1):
+    # newest first
+    return [json.loads(v) for v in redis.lrange(key(namespace, name), 0, n - 1)]
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Second opinions from remote agents before calling a service dead.
+
+Only failures are reviewed, so a healthy sweep costs nothing extra.
+Every failed tcp/icmp/http service is sent to every agent listed
+under agents: in site.yml, one bulk POST to /_probe per agent, all
+agents in parallel.  We count as one vantage point ourselves, and
+the service is only dead when at least vantage_quorum of the points
+that answered saw it down.  An agent that doesn't answer abstains,
+so with every agent unreachable we fall back to our own result.
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app as app
+
+import httppool
+
+__version__ = '1.1'
+
+
+def agents():
+    return app.config['VANTAGE_AGENTS']
+
+
+def enabled(svc):
+    return bool(agents()) and svc.probe is not None
+
+
+def headers():
+    # the agents refuse bulk probes without the shared token
+    return {'Authorization': f'Bearer {app.config["AGENT_TOKEN"]}'}
+
+
+def ask(agent, specs, timeout):
+    """
+    POST a batch of probe specs to one agent.  Returns the results
+    by id, or {} if the agent couldn't be reached.
+    """
+
+    url = agent.rstrip('/') + '/_probe'
+    try:
+        r = httppool.get_session().post(
+            url,
+            json={'timeout': timeout, 'probes': specs},
+            headers=headers(),
+            timeout=(timeout, timeout + app.config['AGENT_TIMEOUT'])
+        )
+        r.raise_for_status()
+        return {res['id']: res for res in r.json()['results']}
+    except Exception as e:
+        app.logger.error(f'vantage agent {agent} failed: {e}')
+        return {}
+
+
+def stream(agent, items, timeout):
+    """
+    POST a batch to an agent's /_batch and yield each result dict
+    as the agent streams it back (ndjson, in completion order).
+    Raises if the agent can't be reached.
+    """
+
+    url = agent.rstrip('/') + '/_batch'
+    r = httppool.get_session().post(
+        url,
+        json={'timeout': timeout, 'items': items},
+        headers=headers(),
+        timeout=(app.config['TIMEOUT'], timeout + app.config['AGENT_TIMEOUT']),
+        stream=True
+    )
+    with r:
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
+def review(failures):
+    """
+    @params - failures - [(service, error)] that failed from here
+
+    @return - list() - [(response, error)] in the same order, error
+    is None where the agents outvoted us and the service stays up
+    """
+
+    quorum = app.config['VANTAGE_QUORUM']
+    todo = [(svc, e) for svc, e in failures if enabled(svc)]
+    if not todo:
+        return [(None, e) for _, e in failures]
+
+    specs = [dict(svc.probe, id=svc.name) for svc, _ in todo]
+    timeout = max(svc.timeout for svc, _ in todo)
+    # need the real app obj, the proxy is useless in threads
+    real = app._get_current_object()
+
+    def worker(agent):
+        with real.app_context():
+            return ask(agent, specs, timeout)
+
+    with ThreadPoolExecutor(max_workers=len(agents())) as pool:
+        answers = list(pool.map(worker, agents()))
+
+    verdicts = {}
+    for svc, error in todo:
+        votes = [a[svc.name]['alive'] for a in answers if svc.name in a]
+        down = 1 + votes.count(False)
+        points = 1 + len(votes)
+        if down >= min(quorum, points):
+            verdicts[svc.name] = (None, error)
+        else:
+            app.logger.info(
+                f'{svc.name} down from here but up from '
+                f'{votes.count(True)}/{len(votes)} agents')
+            verdicts[svc.name] = (
+                f'up from {votes.count(True)}/{len(votes)} vantage points '
+                f'(local: {error})', None)
+    return [verdicts.get(svc.name, (None, e)) for svc, e in failures]
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+DHCP probes per second on the agent, scapy vs the byte templates.
+
+    $ python3 bench/bench_dhcp.py [offers.pcap] [n]
+
+Without a pcap, n DHCPOFFERs (plus as much unrelated traffic) are
+generated and written to a temporary one first.  Nothing is sent,
+the capture side is driven by replaying the recorded frames through
+each Capture's dispatch, with a waiting client registered for every
+xid in the file.
+
+    build   - craft one DISCOVER frame
+    parse   - recognise one offer in a sniffed frame
+    demux   - replay the whole pcap through the capture
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+AGENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'agent')
+sys.path.insert(0, AGENT_DIR)
+
+from scapy.all import (    # noqa: E402
+    BOOTP, DHCP, IP, TCP, UDP, Ether, raw, rdpcap, wrpcap)
+
+import dhcp    # noqa: E402
+
+__version__ = '1.0'
+
+MAC = 'aa:bb:cc:dd:ee:ff'
+
+
+def make_pcap(path, n):
+    frames = []
+    for i in range(n):
+        frames.append(
+            Ether(src='00:11:22:33:44:55')
+            / IP(src='10.0.0.1', dst='255.255.255.255')
+            / UDP(sport=67, dport=68)
+            / BOOTP(op=2, xid=i + 1, yiaddr=f'10.0.{i >> 8 & 255}.{i & 255}')
+            / DHCP(options=[('message-type', 'offer'),
+                            ('server_id', '10.0.0.1'), 'end']))
+        frames.append(Ether() / IP(dst='10.0.0.2') / TCP(dport=443))
+    wrpcap(path, frames)
+
+
+def load(path):
+    return [raw(frame) for frame in rdpcap(path)]
+
+
+def rate(fn, items):
+    ts = time.perf_counter()
+    for item in items:
+        fn(item)
+    return len(items) / (time.perf_counter() - ts)
+
+
+def xids(frames):
+    out = []
+    for frame in frames:
+        offer = dhcp.parse_offer(frame)
+        if offer:
+            out.append(offer[0])
+    return out
+
+
+def demux(capture, client_class, frames, feed):
+    offers = xids(frames)
+    clients = [client_class(xid=x) for x in offers]
+    for client in clients:
+        capture.register(client)
+    ts = time.perf_counter()
+    feed(frames)
+    elapsed = time.perf_counter() - ts
+    found = sum(1 for c in clients if c.offered_address)
+    return found, len(offers) / elapsed
+
+
+def main(pcap=None, n=2000):
+    tmp = None
+    if pcap is None:
+        tmp = tempfile.NamedTemporaryFile(suffix='.pcap', delete=False)
+        tmp.close()
+        make_pcap(tmp.name, n)
+        pcap = tmp.name
+    frames = load(pcap)
+    print(f'{len(frames)} frames, {len(xids(frames))} offers in {pcap}')
+
+    dhcp.discover_template()
+    xs = list(range(1, len(frames) + 1))
+    scapy_client = dhcp.DHCPv4Client()
+    build_scapy = rate(
+        lambda x: raw(Ether(dst=dhcp.DHCPv4Client.MAC_BROADCAST)
+                      / scapy_client.craft_discover(MAC)), xs)
+    build_fast = rate(lambda x: dhcp.discover_bytes(x, MAC), xs)
+
+    matcher = dhcp.DHCPv4Client()
+    parse_scapy = rate(lambda f: matcher.is_offer_type(Ether(f)), frames)
+    parse_fast = rate(dhcp.parse_offer, frames)
+
+    # the scapy capture pays for dissecting every frame it sees
+    cap_scapy = dhcp.Capture()
+    found_scapy, demux_scapy = demux(
+        cap_scapy, dhcp.DHCPv4Client, frames,
+        lambda fs: cap_scapy.feed(Ether(f) for f in fs))
+    cap_fast = dhcp.RawCapture()
+    found_fast, demux_fast = demux(
+        cap_fast, dhcp.FastDHCPv4Client, frames, cap_fast.feed_raw)
+
+    print(f'{"per second":10} {"scapy":>12} {"template":>12} {"x":>6}')
+    for label, slow, fast in (('build', build_scapy, build_fast),
+                              ('parse', parse_scapy, parse_fast),
+                              ('demux', demux_scapy, demux_fast)):
+        print(f'{label:10} {slow:>12,.0f} {fast:>12,.0f} {fast / slow:>6.1f}')
+    print(f'offers matched: scapy {found_scapy}, template {found_fast}')
+
+    if tmp is not None:
+        os.unlink(tmp.name)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    pcap = args[0] if args and not args[0].isdigit() else None
+    n = int(args[-1]) if args and args[-1].isdigit() else 2000
+    main(pcap, n)
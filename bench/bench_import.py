@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Worker cold start - how long `import main` takes in a fresh
+interpreter, which is what every gunicorn worker pays at boot.
+
+    $ python3 bench/bench_import.py [runs] [budget ms]
+
+Runs against a small generated config/site.yml, or point SITE_DIR at
+a directory with a real one.  Prints the median and the slowest modules from
+-X importtime, and exits 1 when the median is over budget so it can
+gate a build.  Nothing should touch the network at import, redis
+connects lazily and the dynamodb table is `flask create-tables`.
+"""
+
+import os
+import sys
+import json
+import time
+import statistics
+import tempfile
+import subprocess
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+__version__ = '1.1'
+
+RUNS = 5
+BUDGET_MS = 1500
+TOP = 10
+
+
+# just enough for main to import, json is yaml too
+SITE = {
+    'url': 'bench.local',
+    'config_reload': False,
+    'subscribers': [{'transport': 'email',
+                     'destination': 'bench@example.com'}],
+    'services': [
+        {'name': 'tcp', 'service_type': 'tcp', 'ip': '127.0.0.1',
+         'port': 1},
+        {'name': 'http', 'service_type': 'http',
+         'url': 'http://127.0.0.1:1/'},
+    ],
+}
+
+
+def cold_import(cwd):
+    # main is found on PYTHONPATH, config/site.yml relative to cwd
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(APP_DIR))
+    ts = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'],
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    elapsed = (time.perf_counter() - ts) * 1000
+    if result.returncode != 0:
+        sys.exit(result.stderr[-2000:])
+    return elapsed, result.stderr
+
+
+def slowest(importtime, n=TOP):
+    # "import time: self [us] | cumulative | imported package"
+    rows = []
+    for line in importtime.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.rstrip()))
+    rows.sort(reverse=True)
+    return rows[:n]
+
+
+def measure(cwd, runs):
+    times = []
+    importtime = ''
+    for _ in range(runs):
+        elapsed, importtime = cold_import(cwd)
+        times.append(elapsed)
+    return times, importtime
+
+
+def main(runs=RUNS, budget=BUDGET_MS):
+    if os.environ.get('SITE_DIR'):
+        times, importtime = measure(os.environ['SITE_DIR'], runs)
+    else:
+        with tempfile.TemporaryDirectory(prefix='pyping-import-') as tmp:
+            os.mkdir(os.path.join(tmp, 'config'))
+            with open(os.path.join(tmp, 'config', 'site.yml'), 'w') as f:
+                json.dump(SITE, f)
+            times, importtime = measure(tmp, runs)
+
+    median = statistics.median(times)
+    print(f'import main: median {median:.0f}ms, '
+          f'min {min(times):.0f}ms, max {max(times):.0f}ms '
+          f'over {runs} runs (budget {budget}ms)')
+    print('slowest imports (cumulative):')
+    for us, name in slowest(importtime):
+        print(f'  {us / 1000:8.1f}ms  {name}')
+
+    if median > budget:
+        print('over budget')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(int(args[0]) if args else RUNS,
+         int(args[1]) if len(args) > 1 else BUDGET_MS)
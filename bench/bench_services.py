@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Bytes per service, slotted vs the old __dict__ based objects.
+
+    $ python3 bench/bench_services.py [n]
+
+Measures resident memory (tracemalloc) for n services of each type.
+The "dict" numbers come from a plain object carrying the same
+attributes, which is what every Service looked like before
+__slots__.  "state" is what state.StateStore.save() writes to redis
+for one service, field names and encoded values, the same for both
+layouts.
+"""
+
+import os
+import sys
+import tracemalloc
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP_DIR)
+
+from flask import Flask    # noqa: E402
+
+import services    # noqa: E402
+import state    # noqa: E402
+
+__version__ = '1.1'
+
+KWARGS = {
+    'tcp': {'ip': '10.0.0.1', 'port': 443},
+    'icmp': {'ip': '10.0.0.1'},
+    'http': {'url': 'https://example.com/health'},
+    'ntp': {'ip': '10.0.0.1'},
+    'dhcp': {'url': 'http://agent:6768/_dhcp/<<MAC>>',
+             'mac': 'ab:cd:ef:11:22:33'},
+}
+
+
+class Legacy(object):
+    # stand-in for the pre-slots layout
+    pass
+
+
+def fields(svc):
+    return [f for klass in type(svc).__mro__
+            for f in klass.__dict__.get('__slots__', ())]
+
+
+def legacy_copy(svc):
+    obj = Legacy()
+    for f in fields(svc):
+        setattr(obj, f, getattr(svc, f, None))
+    return obj
+
+
+def slotted_copy(svc):
+    obj = type(svc).__new__(type(svc))
+    for f in fields(svc):
+        setattr(obj, f, getattr(svc, f, None))
+    return obj
+
+
+def state_bytes(svc):
+    # the hset mapping StateStore.save() builds, None fields are hdel'd
+    return sum(len(field) + len(state.encode(value))
+               for field, value in svc.state.items() if value is not None)
+
+
+def build(service_type, n):
+    klass = getattr(services, service_type.upper())
+    out = []
+    for i in range(n):
+        out.append(klass(name=f'{service_type}-{i}', **KWARGS[service_type]))
+    return out
+
+
+def measure(factory):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objs = factory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    mem = sum(s.size_diff for s in stats)
+    return objs, mem
+
+
+def main(n=10000):
+    app = Flask('bench')
+    app.config.update(
+        TIMEOUT=3,
+        CHECK_INTERVAL=300,
+        CHECK_JITTER=0.1,
+        HTTP_HEAD_ONLY=False,
+        MAC_PLACEHOLDER='<<MAC>>'
+    )
+
+    print(f'{n} services per type, bytes per service')
+    print(f'{"type":6} {"mem dict":>10} {"mem slots":>10} {"state":>8}')
+    with app.app_context():
+        for service_type in KWARGS:
+            slotted = build(service_type, n)
+            # copies share the attribute values, so only the
+            # object layout itself is measured
+            _, mem_slots = measure(lambda: [slotted_copy(s) for s in slotted])
+            _, mem_dict = measure(lambda: [legacy_copy(s) for s in slotted])
+            size = state_bytes(slotted[0])
+            print(f'{service_type:6} {mem_dict // n:>10} {mem_slots // n:>10} '
+                  f'{size:>8}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+The whole pinger against fake targets (see targets.py), at a few
+sizes, with the numbers written to json to compare run to run.
+
+    $ python3 bench/bench_sweep.py [--sizes 10,100,1000,10000]
+          [--runs 3] [--out bench_sweep.json] [--compare old.json]
+          [--dynamodb http://localhost:8000]
+
+Every size runs in a fresh child process: a generated site.yml,
+fakeredis for redis, moto (or --dynamodb, e.g. DynamoDB Local) for
+dynamodb, then `import main` and the flask test client.  Needs
+fakeredis and moto[server] on top of app/requirements.txt.
+
+    cold      the first /_cron, nothing in redis yet
+    cron      median of --runs more /_cron, and its phases from the
+              sweep trace (see tracing.py)
+    probes/s  services / sweep phase
+    pages     median GET / (page cache hit), GET / with If-None-Match,
+              a fresh render_index() and GET /api/v1/status
+    rss       peak resident memory of the child
+
+The mix is mostly healthy tcp/http/ntp/dhcp, with 5% black-holed tcp
+(each costs the full TIMEOUT), 5% http 503 and 5% http flapping up and
+down every sweep, which keeps incidents going to dynamodb and
+notifications to the queue.  No icmp, that needs raw sockets.  ntp
+needs port 123, without root those services are tcp instead.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..', 'app')
+
+__version__ = '1.0'
+
+SIZES = (10, 100, 1000, 10000)
+RUNS = 3
+PAGE_RUNS = 20
+
+# one slot per 5% of the services
+MIX = ('tcp',) * 7 + ('blackhole', 'http', 'http', 'http', 'http_slow',
+                      'http_slow', 'http_slow', 'http_503', 'flap',
+                      'ntp', 'ntp', 'dhcp', 'dhcp')
+
+
+def service(i, kind, ports):
+    name = f'{kind}-{i}'
+    group = f'group-{i % 10}'
+    if kind == 'ntp' and not ports['ntp']:
+        kind = 'tcp'
+    if kind == 'tcp':
+        return {'name': name, 'service_type': 'tcp', 'group': group,
+                'ip': '127.0.0.1', 'port': ports['tcp_open']}
+    if kind == 'blackhole':
+        return {'name': name, 'service_type': 'tcp', 'group': group,
+                'ip': '127.0.0.1', 'port': ports['tcp_blackhole']}
+    if kind == 'ntp':
+        return {'name': name, 'service_type': 'ntp', 'group': group,
+                'ip': '127.0.0.1'}
+    if kind == 'dhcp':
+        mac = ':'.join(f'{b:02x}' for b in (0x02, 0, 0, i >> 16 & 255,
+                                            i >> 8 & 255, i & 255))
+        return {'name': name, 'service_type': 'dhcp', 'group': group,
+                'url': f'http://127.0.0.1:{ports["agent"]}/_dhcp/<<MAC>>',
+                'mac': mac}
+    base = f'http://127.0.0.1:{ports["http"]}'
+    path = {
+        'http': f'/200/{i % 3}',
+        'http_slow': f'/200/{50 + i % 100}',
+        'http_503': '/503/0',
+        'flap': f'/flap/{i}',
+    }[kind]
+    return {'name': name, 'service_type': 'http', 'group': group,
+            'url': base + path}
+
+
+def site(n, ports):
+    return {
+        'url': 'bench.local',
+        'check_recheck': 0,
+        'config_reload': False,
+        # queued, nothing here sends them
+        'notify_queue': True,
+        'subscribers': [{'transport': 'email',
+                         'destination': 'bench@example.com'}],
+        'services': [service(i, MIX[i % len(MIX)], ports) for i in range(n)],
+    }
+
+
+def median_ms(fn, runs=PAGE_RUNS):
+    times = []
+    for _ in range(runs):
+        ts = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - ts) * 1000)
+    return round(statistics.median(times), 2)
+
+
+#################################
+#                               #
+#         Child                 #
+#                               #
+#################################
+
+
+def child(n, runs, ports, result_path):
+    """
+    One size, in its own process so memory and module state start
+    clean.  Runs with the generated config/ as the working dir.
+    """
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['DYNAMODB_HOST'] = ports['dynamodb']
+    sys.path.insert(0, APP_DIR)
+
+    import fakeredis
+    import redis
+    server = fakeredis.FakeServer()
+    redis.Redis.from_url = classmethod(
+        lambda cls, url, **kw: fakeredis.FakeRedis(server=server))
+
+    import main
+    import models
+    import tracing
+    # every down service logs an error, keep the terminal out of it
+    logging.disable(logging.ERROR)
+
+    app = main.app
+    client = app.test_client()
+    with app.app_context():
+        models.create_tables()
+
+    def cron():
+        ts = time.perf_counter()
+        r = client.get('/_cron')
+        assert r.status_code == 200, r.status_code
+        ms = (time.perf_counter() - ts) * 1000
+        trace, = tracing.recent(app.redis, 'bench.local', 'cron')
+        phases = {p['name']: p['ms'] for p in trace['phases']}
+        return ms, phases
+
+    cold, _ = cron()
+    crons = [cron() for _ in range(runs)]
+    cron_ms = statistics.median(ms for ms, _ in crons)
+    phases = {
+        name: round(statistics.median(p[name] for _, p in crons), 2)
+        for name in crons[0][1]
+    }
+
+    etag = client.get('/').headers.get('ETag')
+    with app.app_context():
+        render = median_ms(main.render_index, max(runs, 3))
+        down = sum(1 for svc in main.Pinger.load().services
+                   if not svc.is_alive)
+    result = {
+        'services': n,
+        'down': down,
+        'cold_cron_ms': round(cold, 2),
+        'cron_ms': round(cron_ms, 2),
+        'phases_ms': phases,
+        'probes_per_sec': round(n / (phases['sweep'] / 1000), 1),
+        'index_hit_ms': median_ms(lambda: client.get('/')),
+        'index_304_ms': median_ms(
+            lambda: client.get('/', headers={'If-None-Match': etag})),
+        'index_render_ms': render,
+        'api_status_ms': median_ms(lambda: client.get('/api/v1/status')),
+        'rss_mb': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    with open(result_path, 'w') as f:
+        json.dump(result, f)
+
+
+#################################
+#                               #
+#         Driver                #
+#                               #
+#################################
+
+
+def run_size(n, runs, ports):
+    with tempfile.TemporaryDirectory(prefix='pyping-bench-') as tmp:
+        os.mkdir(os.path.join(tmp, 'config'))
+        with open(os.path.join(tmp, 'config', 'site.yml'), 'w') as f:
+            # json is yaml too, and much quicker to write at 10k
+            json.dump(site(n, ports), f)
+        result_path = os.path.join(tmp, 'result.json')
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', str(n),
+             '--runs', str(runs), '--ports', json.dumps(ports),
+             '--result', result_path],
+            cwd=tmp,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+        if proc.returncode != 0:
+            sys.exit(proc.stderr[-3000:])
+        with open(result_path) as f:
+            return json.load(f)
+
+
+def git_rev():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+            capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def report(results):
+    print(f'{"services":>8} {"cold ms":>9} {"cron ms":>9} {"sweep ms":>9} '
+          f'{"probes/s":>9} {"index ms":>9} {"render ms":>10} '
+          f'{"api ms":>8} {"rss mb":>7}')
+    for r in results.values():
+        print(f'{r["services"]:>8} {r["cold_cron_ms"]:>9.0f} '
+              f'{r["cron_ms"]:>9.0f} {r["phases_ms"]["sweep"]:>9.0f} '
+              f'{r["probes_per_sec"]:>9.0f} {r["index_hit_ms"]:>9.2f} '
+              f'{r["index_render_ms"]:>10.1f} {r["api_status_ms"]:>8.1f} '
+              f'{r["rss_mb"]:>7.0f}')
+
+
+def compare(old, new):
+    """
+    Change per metric against an earlier results file, sizes that
+    are in both.  Lower is better for all of them but probes/s.
+    """
+
+    print(f'\nvs {old.get("git") or "?"} from {old.get("started")}:')
+    common = [s for s in new['sizes'] if s in old.get('sizes', {})]
+    if not common:
+        print('  no sizes in common')
+    for size in common:
+        r, before = new['sizes'][size], old['sizes'][size]
+        changes = []
+        for key, value in r.items():
+            was = before.get(key)
+            if not isinstance(value, (int, float)) or not was:
+                continue
+            if key in ('services', 'down'):
+                continue
+            changes.append(f'{key} {(value - was) / was * 100:+.0f}%')
+        print(f'{size:>8}  ' + ', '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)))
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--out', default='bench_sweep.json')
+    parser.add_argument('--compare')
+    parser.add_argument('--dynamodb', help='url of a dynamodb stand-in')
+    parser.add_argument('--offer-ms', type=int, default=20)
+    # internal, one size in a child process
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--ports', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.child, args.runs, json.loads(args.ports),
+                     args.result)
+
+    sys.path.insert(0, BENCH_DIR)
+    import targets
+    t = targets.Targets(args.offer_ms, args.dynamodb).start()
+    ports = t.ports()
+    if not ports['dynamodb']:
+        sys.exit('no dynamodb: pip install "moto[server]" or --dynamodb')
+
+    results = {
+        'version': __version__,
+        'git': git_rev(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'host': platform.node(),
+        'cpus': os.cpu_count(),
+        'runs': args.runs,
+        'ntp': bool(ports['ntp']),
+        'sizes': {},
+    }
+    try:
+        for n in map(int, args.sizes.split(',')):
+            results['sizes'][str(n)] = run_size(n, args.runs, ports)
+            print(f'{n} services done', file=sys.stderr)
+    finally:
+        t.stop()
+
+    report(results['sizes'])
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'results in {args.out}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# This software is in the public domain, furnished "as is", without technical
+# support, and with no warranty, express or implied, as to its usefulness for
+# any purpose.
+#
+#  Author: Jamie Hopper <jh@mode14.com>
+# --------------------------------------------------------------------------
+
+"""
+Fake things for pyping to check, all on 127.0.0.1, for bench_sweep.py.
+Everything but dynamodb runs on one asyncio loop in a daemon thread.
+
+    tcp_open        accepts and hangs up
+    tcp_blackhole   listens with a one slot backlog and never accepts,
+                    past the first handshake the SYNs go unanswered
+    http            GET /<status>/<delay ms>, and /flap/<key> which
+                    answers 200 and 503 in turn for each key
+    ntp             udp 123 (needs root), answers with the time now
+    agent           the agent's /_dhcp/<mac> and /_batch, every mac
+                    gets an offer after offer_ms
+    dynamodb        moto's server mode, point DYNAMODB_HOST at it
+
+    $ python3 bench/targets.py      # just run them, for poking at
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import threading
+
+from aiohttp import web
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP_DIR)
+
+from aprobe import NTP_PACKET, to_ntp_time    # noqa: E402
+
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+__version__ = '1.0'
+
+HOST = '127.0.0.1'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+def bound(kind=socket.SOCK_STREAM, port=0):
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((HOST, port))
+    return sock
+
+
+class NTPServer(asyncio.DatagramProtocol):
+    # just enough RFC 5905 for aprobe.NTPProtocol and ntplib
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < NTP_PACKET.size:
+            return
+        client = NTP_PACKET.unpack(data[:NTP_PACKET.size])
+        secs, frac = to_ntp_time(time.time())
+        words = [0] * 11
+        words[5], words[6] = client[13], client[14]    # originate
+        words[7], words[8] = secs, frac                # receive
+        words[9], words[10] = secs, frac               # transmit
+        # LI = 0, VN = 3, Mode = 4 (server), stratum 2
+        self.transport.sendto(NTP_PACKET.pack(0x1c, 2, 0, 0, *words), addr)
+
+
+class Targets:
+    def __init__(self, offer_ms=20, dynamodb=None):
+        self.offer_ms = offer_ms
+        self.flaps = {}
+        self.loop = None
+        self.tcp_open = None
+        self.tcp_blackhole = None
+        self.http = None
+        self.agent = None
+        self.ntp = None
+        self.dynamodb = dynamodb
+        self.moto = None
+        self.blackhole = None
+
+    def start(self):
+        # never accepted, the kernel queue fills and SYNs get dropped
+        self.blackhole = bound()
+        self.blackhole.listen(0)
+        self.tcp_blackhole = self.blackhole.getsockname()[1]
+
+        ready = threading.Event()
+        threading.Thread(
+            target=self._run, args=(ready,), name='targets', daemon=True
+        ).start()
+        ready.wait()
+
+        if self.dynamodb is None and ThreadedMotoServer is not None:
+            port = free_port()
+            self.moto = ThreadedMotoServer(
+                ip_address=HOST, port=port, verbose=False)
+            # werkzeug logs every request otherwise
+            logging.getLogger('werkzeug').setLevel(logging.ERROR)
+            self.moto.start()
+            self.dynamodb = f'http://{HOST}:{port}'
+        return self
+
+    def stop(self):
+        if self.moto is not None:
+            self.moto.stop()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.blackhole.close()
+
+    def ports(self):
+        return {
+            'tcp_open': self.tcp_open,
+            'tcp_blackhole': self.tcp_blackhole,
+            'http': self.http,
+            'agent': self.agent,
+            'ntp': self.ntp,
+            'dynamodb': self.dynamodb,
+        }
+
+    def _run(self, ready):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._serve())
+        ready.set()
+        self.loop.run_forever()
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._hang_up, sock=bound())
+        self.tcp_open = server.sockets[0].getsockname()[1]
+
+        self.http = await self._site(web.get('/{status}/{delay}', self._http),
+                                     web.get('/flap/{key}', self._flap))
+        self.agent = await self._site(web.get('/_dhcp/{mac}', self._dhcp),
+                                      web.post('/_batch', self._batch))
+        try:
+            await self.loop.create_datagram_endpoint(
+                NTPServer, sock=bound(socket.SOCK_DGRAM, 123))
+            self.ntp = 123
+        except OSError:
+            # not root, or a real ntpd has it
+            self.ntp = None
+
+    async def _site(self, *routes):
+        app = web.Application()
+        app.add_routes(routes)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        sock = bound()
+        await web.SockSite(runner, sock, backlog=1024).start()
+        return sock.getsockname()[1]
+
+    async def _hang_up(self, reader, writer):
+        writer.close()
+
+    async def _http(self, request):
+        status = int(request.match_info['status'])
+        await asyncio.sleep(int(request.match_info['delay']) / 1000)
+        return web.Response(status=status, text='bench')
+
+    async def _flap(self, request):
+        key = request.match_info['key']
+        up = self.flaps[key] = not self.flaps.get(key, False)
+        return web.Response(status=200 if up else 503, text='flap')
+
+    def offer(self, mac):
+        return {'alive': True, 'response': f'offered 10.0.0.1 to {mac}'}
+
+    async def _dhcp(self, request):
+        await asyncio.sleep(self.offer_ms / 1000)
+        return web.json_response(self.offer(request.match_info['mac']))
+
+    async def _batch(self, request):
+        body = await request.json()
+        response = web.StreamResponse(
+            headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        await asyncio.sleep(self.offer_ms / 1000)
+        for item in body.get('items', []):
+            if isinstance(item, str):
+                item = {'id': item, 'mac': item}
+            result = dict(self.offer(item.get('mac')), id=item.get('id'))
+            await response.write(json.dumps(result).encode() + b'\n')
+        await response.write_eof()
+        return response
+
+
+if __name__ == '__main__':
+    targets = Targets().start()
+    print(json.dumps(targets.ports(), indent=2))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        targets.stop()